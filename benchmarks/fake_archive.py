@@ -0,0 +1,123 @@
+"""A local stand-in for the science archive, serving frame records and synthetic FITS files
+
+Frames are grouped into observations of three frames each, taken through the rp, V and B filters,
+so that both black and white and color thumbnails can be generated from them. Each synthetic frame
+looks like a reduced frame: a tile compressed SCI extension holding a noisy star field and a CAT
+extension with the catalog of those stars, which is what image alignment uses.
+"""
+import io
+import json
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+from astropy.io import fits
+
+FILTERS = ('rp', 'V', 'B')
+
+
+def make_fits(size, seed, shift=(0, 0), n_stars=150):
+    """Return the bytes of a tile compressed FITS file of a size x size star field"""
+    rng = np.random.default_rng(seed)
+    star_rng = np.random.default_rng(0)
+    data = rng.normal(1000, 30, (size, size)).astype(np.float32)
+    xs = star_rng.uniform(10, size - 10, n_stars) + shift[0]
+    ys = star_rng.uniform(10, size - 10, n_stars) + shift[1]
+    fluxes = star_rng.uniform(500, 20000, n_stars)
+    for x, y, flux in zip(xs, ys, fluxes):
+        x0, y0 = int(x), int(y)
+        if 2 <= x0 < size - 2 and 2 <= y0 < size - 2:
+            data[y0 - 2:y0 + 3, x0 - 2:x0 + 3] += flux / 25
+    catalog = fits.BinTableHDU.from_columns([
+        fits.Column(name='X', format='E', array=xs),
+        fits.Column(name='Y', format='E', array=ys),
+        fits.Column(name='FWHM', format='E', array=np.full(n_stars, 2.5)),
+        fits.Column(name='ELLIPTICITY', format='E', array=np.zeros(n_stars)),
+        fits.Column(name='FLUX', format='E', array=fluxes),
+    ], name='CAT')
+    hdul = fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data, name='SCI'), catalog])
+    buffer = io.BytesIO()
+    hdul.writeto(buffer)
+    return buffer.getvalue()
+
+
+class FakeArchive:
+    def __init__(self, observations, frame_size, host='127.0.0.1'):
+        self.frame_size = frame_size
+        self.frames = {}
+        self._files = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, 0), self._handler())
+        self.url = f'http://{host}:{self.server.server_port}/'
+        for observation in range(observations):
+            for index, filter_name in enumerate(FILTERS):
+                frame_id = observation * len(FILTERS) + index + 1
+                self.frames[frame_id] = {
+                    'id': frame_id,
+                    'filename': f'fake-{frame_id:06d}-e91.fits.fz',
+                    'basename': f'fake-{frame_id:06d}-e91',
+                    'url': f'{self.url}files/{frame_id}.fits.fz',
+                    'configuration_type': 'EXPOSE',
+                    'proposal_id': 'BENCHMARK',
+                    'request_id': observation + 1,
+                    'primary_optical_element': filter_name,
+                    'reduction_level': 91,
+                }
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def file_bytes(self, frame_id):
+        with self._lock:
+            if frame_id not in self._files:
+                # Frames of an observation are slightly offset from each other, as they would be on sky
+                index = (frame_id - 1) % len(FILTERS)
+                self._files[frame_id] = make_fits(self.frame_size, seed=frame_id, shift=(index * 1.5, index * -1.0))
+            return self._files[frame_id]
+
+    def _handler(self):
+        archive = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send_body(self, body, content_type, status=200):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_json(self, value, status=200):
+                self.send_body(json.dumps(value).encode(), 'application/json', status)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                parts = [part for part in url.path.split('/') if part]
+                if parts[:1] == ['files'] and len(parts) == 2:
+                    frame_id = int(parts[1].split('.')[0])
+                    if frame_id in archive.frames:
+                        return self.send_body(archive.file_bytes(frame_id), 'application/fits')
+                elif parts == ['frames']:
+                    results = [
+                        frame for frame in archive.frames.values()
+                        if ('basename' not in query or frame['basename'] == query['basename'])
+                        and ('request_id' not in query or str(frame['request_id']) == query['request_id'])
+                    ]
+                    return self.send_json({'count': len(results), 'results': results})
+                elif parts[:1] == ['frames'] and len(parts) == 2 and parts[1].isdigit():
+                    frame = archive.frames.get(int(parts[1]))
+                    if frame is not None:
+                        return self.send_json(frame)
+                self.send_json({'detail': 'Not found.'}, status=404)
+
+        return Handler
@@ -0,0 +1,177 @@
+"""Drive the thumbnail service with a mixed workload and report latency, throughput and resource use
+
+The real Flask app is served over HTTP, backed by a local fake archive that serves synthetic FITS
+files and by an in-process S3 stand-in. Nothing outside of this process is contacted. Run from the
+repository root with, for example:
+
+    poetry run python -m benchmarks.load --requests 200 --concurrency 8 --hit-ratio 0.8 --color-ratio 0.1
+
+Use --json to write the results to a file so that runs against different commits can be compared.
+Peak RSS is that of the whole benchmark process, which includes the fake archive and the clients.
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from moto import mock_s3
+from werkzeug.serving import make_server
+
+from thumbservice import common
+from thumbservice import thumbservice
+from benchmarks.fake_archive import FakeArchive, FILTERS
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+class TempDirMonitor:
+    """Sample the size of a directory in the background, keeping the high-water mark"""
+    def __init__(self, directory, interval=0.05):
+        self.directory = directory
+        self.interval = interval
+        self.high_water = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.high_water = max(self.high_water, thumbservice.temp_dir_usage())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+def build_workload(args, observations):
+    """Return the (path, is_hit) of each request, and the paths that must be generated beforehand"""
+    rng = random.Random(args.seed)
+    warm_paths = set()
+    workload = []
+    for index in range(args.requests):
+        observation = rng.randrange(observations)
+        color = rng.random() < args.color_ratio
+        # The visual frame is used for black and white thumbnails
+        frame_id = observation * len(FILTERS) + 2
+        query = 'color=true' if color else 'color=false'
+        if rng.random() < args.hit_ratio:
+            path = f'/{frame_id}/?{query}&width=200&height=200'
+            warm_paths.add(path)
+            workload.append((path, True))
+        else:
+            # Every miss asks for a size that nobody has asked for before
+            path = f'/{frame_id}/?{query}&width={300 + index}&height={300 + index}'
+            workload.append((path, False))
+    return workload, sorted(warm_paths)
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as tmp_dir, mock_s3():
+        archive = FakeArchive(args.observations, args.frame_size).start()
+        thumbservice.settings = common.Settings(settings={
+            'ARCHIVE_API_URL': archive.url,
+            'TMP_DIR': os.path.join(tmp_dir, 'tmp'),
+            'METRICS_DIR': os.path.join(tmp_dir, 'metrics'),
+            'AWS_BUCKET': 'benchmark',
+            'AWS_ACCESS_KEY_ID': 'benchmark',
+            'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        })
+        os.makedirs(thumbservice.settings.TMP_DIR)
+        common.reset_process_locals()
+        thumbservice.get_s3_client().create_bucket(
+            Bucket='benchmark', CreateBucketConfiguration={'LocationConstraint': 'us-west-2'}
+        )
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        server = make_server('127.0.0.1', 0, thumbservice.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.server_port}'
+
+        workload, warm_paths = build_workload(args, args.observations)
+        session_local = threading.local()
+
+        def get(path):
+            if not hasattr(session_local, 'session'):
+                session_local.session = requests.Session()
+            start = time.monotonic()
+            response = session_local.session.get(f'{base_url}{path}', timeout=600)
+            return time.monotonic() - start, response.status_code
+
+        print(f'Generating {len(warm_paths)} thumbnails for cache hits', file=sys.stderr)
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            list(executor.map(get, warm_paths))
+
+        print(f'Running {len(workload)} requests with {args.concurrency} clients', file=sys.stderr)
+        with TempDirMonitor(thumbservice.settings.TMP_DIR) as monitor, ThreadPoolExecutor(args.concurrency) as executor:
+            start = time.monotonic()
+            results = list(executor.map(lambda request: (request[1], get(request[0])), workload))
+            elapsed = time.monotonic() - start
+
+        server.shutdown()
+        archive.stop()
+
+    report = {
+        'requests': len(results),
+        'concurrency': args.concurrency,
+        'errors': sum(1 for _, (_, status_code) in results if status_code != 200),
+        'elapsed_seconds': elapsed,
+        'throughput_rps': len(results) / elapsed,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'temp_dir_high_water_bytes': monitor.high_water,
+    }
+    for name, selected in [('all', None), ('hit', True), ('miss', False)]:
+        latencies = sorted(latency for is_hit, (latency, _) in results if selected is None or is_hit == selected)
+        report[f'{name}_count'] = len(latencies)
+        for label, fraction in [('p50', 0.5), ('p95', 0.95), ('p99', 0.99)]:
+            report[f'{name}_{label}_ms'] = percentile(latencies, fraction) * 1000
+    return report
+
+
+def print_report(report):
+    print(f'{report["requests"]} requests, {report["concurrency"]} clients, {report["errors"]} errors')
+    print(f'Throughput {report["throughput_rps"]:.2f} requests/s over {report["elapsed_seconds"]:.2f}s')
+    for name in ['all', 'hit', 'miss']:
+        print(
+            f'{name:<5} n={report[f"{name}_count"]:<5} p50 {report[f"{name}_p50_ms"]:9.2f} ms  '
+            f'p95 {report[f"{name}_p95_ms"]:9.2f} ms  p99 {report[f"{name}_p99_ms"]:9.2f} ms'
+        )
+    print(f'Peak RSS {report["peak_rss_kb"] / 1024:.1f} MB')
+    print(f'Temp dir high-water {report["temp_dir_high_water_bytes"] / 1024 / 1024:.1f} MB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=100, help='Number of timed requests')
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of clients making requests at the same time')
+    parser.add_argument('--hit-ratio', type=float, default=0.8, help='Fraction of requests for thumbnails that already exist')
+    parser.add_argument('--color-ratio', type=float, default=0.1, help='Fraction of requests for color thumbnails')
+    parser.add_argument('--observations', type=int, default=10, help='Number of observations of three frames each in the fake archive')
+    parser.add_argument('--frame-size', type=int, default=1024, help='Width and height in pixels of the synthetic frames')
+    parser.add_argument('--seed', type=int, default=0, help='Seed used to build the workload')
+    parser.add_argument('--json', help='Also write the results as JSON to this path')
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
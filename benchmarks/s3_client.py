@@ -0,0 +1,64 @@
+"""Compare building an S3 client per call against reusing the pooled per-process client
+
+A cache hit does a head_object followed by a presign. Before clients were pooled, each of those
+calls built its own client. Run from the repository root with:
+
+    poetry run python -m benchmarks.s3_client
+"""
+import timeit
+import argparse
+import statistics
+
+from moto import mock_s3
+
+from thumbservice import thumbservice
+from thumbservice.common import reset_process_locals
+
+KEY = 'benchmark.jpg'
+
+
+def cache_hit_with_new_clients():
+    thumbservice.build_s3_client().head_object(Bucket=thumbservice.settings.AWS_BUCKET, Key=KEY)
+    thumbservice.build_s3_client().generate_presigned_url(
+        'get_object', ExpiresIn=3600, Params={'Bucket': thumbservice.settings.AWS_BUCKET, 'Key': KEY}
+    )
+
+
+def cache_hit_with_pooled_client():
+    thumbservice.get_s3_client().head_object(Bucket=thumbservice.settings.AWS_BUCKET, Key=KEY)
+    thumbservice.get_s3_client().generate_presigned_url(
+        'get_object', ExpiresIn=3600, Params={'Bucket': thumbservice.settings.AWS_BUCKET, 'Key': KEY}
+    )
+
+
+def report(name, timings):
+    timings_ms = sorted(timing * 1000 for timing in timings)
+    print(
+        f'{name:<12} mean {statistics.mean(timings_ms):8.2f} ms  '
+        f'p50 {timings_ms[len(timings_ms) // 2]:8.2f} ms  '
+        f'p95 {timings_ms[int(len(timings_ms) * 0.95)]:8.2f} ms'
+    )
+    return statistics.mean(timings_ms)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='Number of simulated cache hits to time')
+    args = parser.parse_args()
+
+    with mock_s3():
+        reset_process_locals()
+        client = thumbservice.get_s3_client()
+        client.create_bucket(Bucket=thumbservice.settings.AWS_BUCKET, CreateBucketConfiguration={'LocationConstraint': 'us-west-2'})
+        client.put_object(Bucket=thumbservice.settings.AWS_BUCKET, Key=KEY, Body=b'')
+
+        new_clients = timeit.repeat(cache_hit_with_new_clients, number=1, repeat=args.requests)
+        pooled_client = timeit.repeat(cache_hit_with_pooled_client, number=1, repeat=args.requests)
+
+    new_mean = report('new clients', new_clients)
+    pooled_mean = report('pooled', pooled_client)
+    print(f'Saved {new_mean - pooled_mean:.2f} ms per cache hit')
+
+
+if __name__ == '__main__':
+    main()
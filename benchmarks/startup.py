@@ -0,0 +1,52 @@
+"""Measure how long a fresh worker process takes to import the app and get ready to serve
+
+Each step is timed in a new Python process, so nothing is already imported. Importing the app is
+what every worker pays on boot. Warming up adds building the S3 and HTTP clients, which the
+post_worker_init hook does before the worker takes requests. Preloading rendering adds importing
+astropy, fits2image and fits_align, which a worker otherwise does on its first render, and which
+is roughly what importing the app cost before those imports were deferred. Run from the
+repository root with:
+
+    poetry run python -m benchmarks.startup
+"""
+import sys
+import argparse
+import statistics
+import subprocess
+
+STEPS = {
+    'import': 'from thumbservice import thumbservice',
+    'import + warm up': 'from thumbservice import thumbservice; thumbservice.warm_up()',
+    'import + preload rendering': 'from thumbservice import thumbservice; thumbservice.preload_rendering()',
+}
+
+TIMER = '''
+import time
+start = time.perf_counter()
+{code}
+print(time.perf_counter() - start)
+'''
+
+
+def time_in_new_process(code):
+    output = subprocess.run(
+        [sys.executable, '-c', TIMER.format(code=code)], check=True, capture_output=True, text=True
+    ).stdout
+    return float(output.split()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='Number of new processes to time each step in')
+    args = parser.parse_args()
+
+    # The first run of each step may also be reading files into the OS page cache, so it is discarded
+    for code in STEPS.values():
+        time_in_new_process(code)
+    for name, code in STEPS.items():
+        timings_ms = sorted(time_in_new_process(code) * 1000 for _ in range(args.repeat))
+        print(f'{name:<28} mean {statistics.mean(timings_ms):8.1f} ms  min {timings_ms[0]:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
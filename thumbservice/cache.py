@@ -0,0 +1,324 @@
+import os
+import time
+import uuid
+import fcntl
+import shutil
+import threading
+from collections import OrderedDict
+
+
+class Pin:
+    """A shared lock held on a cache entry, which stops it from being evicted while it is in use"""
+    def __init__(self, path, fd):
+        self.path = path
+        self._fd = fd
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def _is_linked(fd, path):
+    try:
+        return os.fstat(fd).st_ino == os.stat(path).st_ino
+    except FileNotFoundError:
+        return False
+
+
+class LRUFileCache:
+    """Files kept in a single directory, bounded by total size and number of entries
+
+    The modification time of a file is bumped every time it is read, so the directory itself is the
+    LRU index and can be shared by all of the worker processes on a host. Files are written under a
+    temporary name and renamed into place so that readers never see a partially written entry.
+
+    Entries can be pinned with a shared flock while they are in use. Eviction only removes entries it
+    can take an exclusive lock on, so pinned entries are skipped, and the pins of a process that dies
+    are released along with its file descriptors.
+
+    Scanning the directory costs a stat of every entry, so each process keeps a running total of the
+    entries it has written since its last scan, and only scans again once that total goes over the
+    bounds. Eviction leaves a tenth of each bound free, so that the next scan is that many writes away.
+    Entries written by other processes are only counted at the next scan, so the bounds are soft.
+    """
+    TMP_SUFFIX = '.tmp'
+
+    def __init__(self, directory, max_bytes, max_entries):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # The entries and bytes in the directory as of the last scan, plus those written since
+        self._entries_written = None
+        self._bytes_written = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key)
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def open(self, key):
+        """Return the cached file opened for reading, or None if it is not cached
+
+        The open file remains readable even if another process evicts the entry in the meantime.
+        """
+        path = self.path_for(key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            self._count(hit=False)
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self._count(hit=True)
+        return f
+
+    def pin(self, key):
+        """Return a Pin on the cached entry, or None if it is not cached"""
+        path = self.path_for(key)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            self._count(hit=False)
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # The entry is being evicted
+            os.close(fd)
+            self._count(hit=False)
+            return None
+        if not _is_linked(fd, path):
+            os.close(fd)
+            self._count(hit=False)
+            return None
+        os.utime(fd)
+        self._count(hit=True)
+        return Pin(path, fd)
+
+    def _tmp_path(self, key):
+        return f'{self.path_for(key)}.{uuid.uuid4().hex}{self.TMP_SUFFIX}'
+
+    def put(self, key, source_path):
+        """Copy the file at source_path into the cache under key"""
+        tmp_path = self._tmp_path(key)
+        try:
+            shutil.copyfile(source_path, tmp_path)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, self.path_for(key))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._added(size)
+
+    def write(self, key, data):
+        """Write the bytes data into the cache under key"""
+        tmp_path = self._tmp_path(key)
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path_for(key))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._added(len(data))
+
+    def put_pinned(self, key, source_path):
+        """Move the file at source_path into the cache under key, returning a Pin on the new entry"""
+        tmp_path = self._tmp_path(key)
+        os.replace(source_path, tmp_path)
+        fd = os.open(tmp_path, os.O_RDONLY)
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        os.replace(tmp_path, self.path_for(key))
+        self._added(os.fstat(fd).st_size)
+        return Pin(self.path_for(key), fd)
+
+    def _added(self, size):
+        """Count an entry written by this process, evicting if the cache may have gone over its bounds"""
+        with self._lock:
+            within_bounds = self._entries_written is not None
+            if within_bounds:
+                self._entries_written += 1
+                self._bytes_written += size
+                within_bounds = self._entries_written <= self.max_entries and self._bytes_written <= self.max_bytes
+        if not within_bounds:
+            self.evict()
+
+    def entries(self):
+        """Return (mtime, size, path) for every complete entry, least recently used first"""
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.is_file() or entry.name.endswith(self.TMP_SUFFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(entries)
+
+    def evict(self):
+        """Remove the least recently used entries if the cache is over its bounds, until a tenth of each is free"""
+        entries = self.entries()
+        total_bytes = sum(size for _, size, _ in entries)
+        count = len(entries)
+        if count > self.max_entries or total_bytes > self.max_bytes:
+            max_entries = self.max_entries - self.max_entries // 10
+            max_bytes = self.max_bytes - self.max_bytes // 10
+            for _, size, path in entries:
+                if count <= max_entries and total_bytes <= max_bytes:
+                    break
+                if self._remove_unpinned(path):
+                    count -= 1
+                    total_bytes -= size
+        with self._lock:
+            self._entries_written = count
+            self._bytes_written = total_bytes
+
+    @staticmethod
+    def _remove_unpinned(path):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            # Someone else already removed it
+            return True
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if _is_linked(fd, path):
+                os.remove(path)
+                return True
+            return False
+        except BlockingIOError:
+            return False
+        finally:
+            os.close(fd)
+
+    def clean_up(self):
+        """Remove partially written files and enforce the size bounds, for use when nothing else is running"""
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(self.TMP_SUFFIX):
+                    os.remove(entry.path)
+        self.evict()
+
+    def stats(self):
+        entries = self.entries()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+        }
+
+
+class TTLCache:
+    """In memory mapping whose entries expire after a time to live, bounded by number of entries
+
+    When the cache is full the least recently used entry is evicted.
+    """
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if self.max_entries <= 0:
+            return
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class StaleWhileRevalidateCache:
+    """In memory cache of fetched values, which are returned for a while after they go stale
+
+    A stale value is refreshed in the background by the submit function, such as the submit method of
+    an executor, so that callers do not wait for a slow source. Values are fetched again in the
+    foreground once they are older than ttl plus stale_ttl.
+    """
+    def __init__(self, max_entries, ttl, stale_ttl, submit):
+        self.ttl = ttl
+        self._entries = TTLCache(max_entries, ttl + stale_ttl)
+        self._submit = submit
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, key, fetch):
+        """Return the value for the key and whether it was cached, calling fetch if it was not"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return self._fetch(key, fetch), False
+        value, fresh_until = entry
+        if fresh_until <= time.monotonic():
+            self._revalidate(key, fetch)
+        return value, True
+
+    def peek(self, key):
+        """Return the cached value for the key, fresh or stale, or None"""
+        entry = self._entries.get(key)
+        return None if entry is None else entry[0]
+
+    def _fetch(self, key, fetch):
+        value = fetch()
+        self._entries.set(key, (value, time.monotonic() + self.ttl))
+        return value
+
+    def _revalidate(self, key, fetch):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self._fetch(key, fetch)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+        try:
+            self._submit(refresh)
+        except RuntimeError:
+            # The executor has been shut down, the stale value is used until the next fetch
+            with self._lock:
+                self._refreshing.discard(key)
@@ -1,4 +1,5 @@
 import os
+import threading
 
 
 def get_temp_filename_prefix(pid=None):
@@ -8,6 +9,43 @@ def get_temp_filename_prefix(pid=None):
     return f'pid{pid}-'
 
 
+_process_locals = []
+
+
+def reset_process_locals():
+    # Drop every per-process value so that each is created again on next use
+    for process_local in _process_locals:
+        process_local.reset()
+
+
+class ProcessLocal:
+    """Lazily create a value at most once per process
+
+    Thread pools, connection pools and clients must not be shared across a fork, so the value is
+    created again the first time it is used from a process other than the one that created it.
+    """
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._pid = None
+        self._value = None
+        _process_locals.append(self)
+
+    def get(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._value = self._factory()
+                    self._pid = pid
+        return self._value
+
+    def reset(self):
+        with self._lock:
+            self._pid = None
+            self._value = None
+
+
 class Settings:
     def __init__(self, settings=None):
         self._settings = settings or {}
@@ -20,6 +58,62 @@ class Settings:
         self.REQUIRED_FRAME_VALIDATION_KEYS = self.get_tuple_from_environment('REQUIRED_FRAME_VALIDATION_KEYS', 'configuration_type,request_id,filename')
         self.VALID_CONFIGURATION_TYPES = self.get_tuple_from_environment('VALID_CONFIGURATION_TYPES', 'ARC,BIAS,BPM,DARK,DOUBLE,EXPERIMENTAL,EXPOSE,GUIDE,LAMPFLAT,SKYFLAT,SPECTRUM,STANDARD,TARGET,TRAILED')
         self.VALID_CONFIGURATION_TYPES_FOR_COLOR_THUMBS = self.get_tuple_from_environment('VALID_CONFIGURATION_TYPES_FOR_COLOR_THUMBS', 'EXPOSE,STANDARD')
+        self.DOWNLOAD_CHUNK_SIZE = self.set_int_value('DOWNLOAD_CHUNK_SIZE', 1024 * 1024)
+        self.MAX_DOWNLOAD_BYTES = self.set_int_value('MAX_DOWNLOAD_BYTES', 1024 * 1024 * 1024)
+        self.MAX_CONCURRENT_DOWNLOADS = self.set_int_value('MAX_CONCURRENT_DOWNLOADS', 6)
+        self.IN_MEMORY_DECODE_MAX_BYTES = self.set_int_value('IN_MEMORY_DECODE_MAX_BYTES', 64 * 1024 * 1024)
+        self.RENDER_EXECUTOR = self.set_value('RENDER_EXECUTOR', 'inline')
+        self.RENDER_PROCESSES = self.set_int_value('RENDER_PROCESSES', 0)
+        self.HTTP_POOL_MAXSIZE = self.set_int_value('HTTP_POOL_MAXSIZE', 20)
+        self.HTTP_RETRIES = self.set_int_value('HTTP_RETRIES', 2)
+        self.HTTP_RETRY_BACKOFF = self.set_float_value('HTTP_RETRY_BACKOFF', 0.5)
+        self.UPLOAD_WORKERS = self.set_int_value('UPLOAD_WORKERS', 2)
+        self.UPLOAD_QUEUE_MAX_BYTES = self.set_int_value('UPLOAD_QUEUE_MAX_BYTES', 64 * 1024 * 1024)
+        self.UPLOAD_RETRIES = self.set_int_value('UPLOAD_RETRIES', 3)
+        self.HTTP_CONNECT_TIMEOUT = self.set_float_value('HTTP_CONNECT_TIMEOUT', 3.05)
+        self.HTTP_READ_TIMEOUT = self.set_float_value('HTTP_READ_TIMEOUT', 10)
+        self.BATCH_MAX_FRAMES = self.set_int_value('BATCH_MAX_FRAMES', 100)
+        self.MAX_CONCURRENT_BATCH_THUMBNAILS = self.set_int_value('MAX_CONCURRENT_BATCH_THUMBNAILS', 4)
+        self.JOB_QUEUE_BACKEND = self.set_value('JOB_QUEUE_BACKEND', 'sqlite')
+        self.JOB_DB_PATH = self.set_value('JOB_DB_PATH', f'{self.TMP_DIR}jobs.sqlite3')
+        self.JOB_WORKERS = self.set_int_value('JOB_WORKERS', 2)
+        self.JOB_QUEUE_MAX_PENDING = self.set_int_value('JOB_QUEUE_MAX_PENDING', 100)
+        self.JOB_TTL = self.set_int_value('JOB_TTL', 3600)
+        self.WARM_RATE = self.set_float_value('WARM_RATE', 0.5)
+        self.WARM_MAX_PENDING = self.set_int_value('WARM_MAX_PENDING', 100)
+        self.SINGLE_FLIGHT_TIMEOUT = self.set_float_value('SINGLE_FLIGHT_TIMEOUT', 60)
+        self.CHEAP_MAX_RUNNING = self.set_int_value('CHEAP_MAX_RUNNING', 50)
+        self.CHEAP_MAX_WAITING = self.set_int_value('CHEAP_MAX_WAITING', 100)
+        self.CHEAP_WAIT_TIMEOUT = self.set_float_value('CHEAP_WAIT_TIMEOUT', 5)
+        self.EXPENSIVE_MAX_RUNNING = self.set_int_value('EXPENSIVE_MAX_RUNNING', 2)
+        self.EXPENSIVE_MAX_WAITING = self.set_int_value('EXPENSIVE_MAX_WAITING', 10)
+        self.EXPENSIVE_WAIT_TIMEOUT = self.set_float_value('EXPENSIVE_WAIT_TIMEOUT', 30)
+        self.ADMISSION_RETRY_AFTER = self.set_int_value('ADMISSION_RETRY_AFTER', 5)
+        self.TRUSTED_PROXIES = self.set_int_value('TRUSTED_PROXIES', 0)
+        self.LOCAL_CACHE_DIR = self.set_value('LOCAL_CACHE_DIR', '')
+        self.LOCAL_CACHE_MAX_BYTES = self.set_int_value('LOCAL_CACHE_MAX_BYTES', 1024 * 1024 * 1024)
+        self.LOCAL_CACHE_MAX_ENTRIES = self.set_int_value('LOCAL_CACHE_MAX_ENTRIES', 10000)
+        self.FRAME_CACHE_MAX_BYTES = self.set_int_value('FRAME_CACHE_MAX_BYTES', 0)
+        self.FRAME_CACHE_MAX_ENTRIES = self.set_int_value('FRAME_CACHE_MAX_ENTRIES', 50)
+        # Downloads are moved into the frame cache, so it must be on the same filesystem as TMP_DIR
+        self.FRAME_CACHE_DIR = f'{self.TMP_DIR}frame-cache/'
+        self.ALIGNMENT_CACHE_MAX_ENTRIES = self.set_int_value('ALIGNMENT_CACHE_MAX_ENTRIES', 1000)
+        self.ALIGNMENT_CACHE_DIR = self.set_value('ALIGNMENT_CACHE_DIR', f'{self.TMP_DIR}alignment-cache/')
+        self.S3_CACHE_MAX_ENTRIES = self.set_int_value('S3_CACHE_MAX_ENTRIES', 10000)
+        self.S3_KEY_EXISTS_TTL = self.set_int_value('S3_KEY_EXISTS_TTL', 3600)
+        self.PRESIGNED_URL_MIN_REMAINING = self.set_int_value('PRESIGNED_URL_MIN_REMAINING', 3600)
+        self.DIRECT_IMAGE_RESPONSES = self.set_bool_value('DIRECT_IMAGE_RESPONSES', False)
+        self.IMAGE_MAX_AGE = self.set_int_value('IMAGE_MAX_AGE', 86400)
+        self.ARCHIVE_CACHE_MAX_ENTRIES = self.set_int_value('ARCHIVE_CACHE_MAX_ENTRIES', 10000)
+        self.ARCHIVE_CACHE_TTL = self.set_int_value('ARCHIVE_CACHE_TTL', 60)
+        self.ARCHIVE_CACHE_STALE_TTL = self.set_int_value('ARCHIVE_CACHE_STALE_TTL', 600)
+        self.ARCHIVE_CACHE_REFRESH_WORKERS = self.set_int_value('ARCHIVE_CACHE_REFRESH_WORKERS', 2)
+        self.METRICS_DIR = self.set_value('METRICS_DIR', f'{self.TMP_DIR}metrics/')
+        self.METRICS_FLUSH_INTERVAL = self.set_float_value('METRICS_FLUSH_INTERVAL', 1)
+        self.S3_MAX_POOL_CONNECTIONS = self.set_int_value('S3_MAX_POOL_CONNECTIONS', 20)
+        self.PRELOAD_APP = self.set_bool_value('PRELOAD_APP', False)
+        self.WARM_UP_WORKERS = self.set_bool_value('WARM_UP_WORKERS', True)
+        self.RENDITION_SIZES = tuple(int(size) for size in self.get_tuple_from_environment('RENDITION_SIZES', '200,500,1000'))
 
     def set_value(self, env_var, default, must_end_with_slash=False):
         if env_var in self._settings:
@@ -28,6 +122,15 @@ class Settings:
             value = os.getenv(env_var, default)
         return self.end_with_slash(value) if must_end_with_slash else value
 
+    def set_int_value(self, env_var, default):
+        return int(self.set_value(env_var, default))
+
+    def set_float_value(self, env_var, default):
+        return float(self.set_value(env_var, default))
+
+    def set_bool_value(self, env_var, default):
+        return str(self.set_value(env_var, default)).lower() in ('true', '1', 'yes')
+
     @staticmethod
     def end_with_slash(path):
         return os.path.join(path, '')
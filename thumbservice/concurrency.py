@@ -0,0 +1,205 @@
+import os
+import time
+import fcntl
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key so that the work is only done once
+
+    Within a process, callers that arrive while a call for the same key is in flight wait for the
+    leader's result. Across processes, the leader holds an exclusive lock on a file in lock_dir, and
+    the leaders of other processes wait for that lock before calling fn, so fn should first check
+    whether the work has already been done. Anyone who waits longer than timeout seconds gives up
+    and calls fn themselves. If fn leaves work running in the background, hold is called with its
+    result and may return a Future of that work, which the file lock is then held until is done.
+    """
+    def __init__(self, lock_dir, timeout, poll_interval=0.1):
+        self.lock_dir = lock_dir
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, hold=None):
+        with self._lock:
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._in_flight[key] = Future()
+
+        if not is_leader:
+            try:
+                return future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                logger.warning(f'Timed out waiting for {key} to be generated, generating it again')
+                return fn()
+
+        try:
+            result = self._do_with_file_lock(key, fn, hold)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def lock_path(self, key):
+        return os.path.join(self.lock_dir, f'{key}.lock')
+
+    def _do_with_file_lock(self, key, fn, hold):
+        fd = self._acquire_file_lock(key)
+        held = None
+        try:
+            result = fn()
+            if hold is not None and fd is not None:
+                held = hold(result)
+            return result
+        finally:
+            if fd is not None:
+                if held is None:
+                    self._release_file_lock(key, fd)
+                else:
+                    held.add_done_callback(lambda _: self._release_file_lock(key, fd))
+
+    def _acquire_file_lock(self, key):
+        path = self.lock_path(key)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                if time.monotonic() > deadline:
+                    logger.warning(f'Timed out waiting for another process to generate {key}, generating it again')
+                    return None
+                time.sleep(self.poll_interval)
+                continue
+            # The previous holder removes the file before unlocking it, in which case the lock that
+            # was just acquired is on a file nobody else can see anymore
+            try:
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def _release_file_lock(self, key, fd):
+        try:
+            os.remove(self.lock_path(key))
+        except FileNotFoundError:
+            pass
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+class Rejected(Exception):
+    pass
+
+
+class Admission:
+    """A place in an AdmissionBudget, which is given back by release or on leaving the with block"""
+    def __init__(self, budget):
+        self._budget = budget
+
+    def release(self):
+        if self._budget is not None:
+            self._budget._release()
+            self._budget = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class AdmissionBudget:
+    """Limit how many callers run at once, with a bounded queue of callers waiting their turn
+
+    Waiting callers are admitted round robin by client, so a client with many requests waiting
+    cannot hold up everyone else. Callers are rejected straight away if the queue is full, or once
+    they have waited for timeout seconds.
+    """
+    def __init__(self, max_running, max_waiting, timeout):
+        self.max_running = max_running
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.running = 0
+        self.waiting = 0
+        self._queues = OrderedDict()
+        self._lock = threading.Lock()
+
+    def admit(self, client):
+        """Return an Admission once there is room, raising Rejected if there is not going to be"""
+        with self._lock:
+            if self.running < self.max_running and not self.waiting:
+                self.running += 1
+                return Admission(self)
+            if self.waiting >= self.max_waiting:
+                raise Rejected()
+            waiter = threading.Event()
+            self._queues.setdefault(client, deque()).append(waiter)
+            self.waiting += 1
+
+        if not waiter.wait(self.timeout):
+            with self._lock:
+                # The place may have been handed over just as the wait timed out
+                if not waiter.is_set():
+                    self._queues[client].remove(waiter)
+                    if not self._queues[client]:
+                        del self._queues[client]
+                    self.waiting -= 1
+                    raise Rejected()
+        return Admission(self)
+
+    def _release(self):
+        with self._lock:
+            if not self._queues:
+                self.running -= 1
+                return
+            # Hand the place straight over to the first waiter of the next client in turn
+            client, waiters = next(iter(self._queues.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                self._queues.move_to_end(client)
+            else:
+                del self._queues[client]
+            self.waiting -= 1
+            waiter.set()
+
+
+class RateLimiter:
+    """Space out callers of wait to an average of rate per second, letting through bursts of up to burst
+
+    A rate of 0 or less does not limit anything.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
@@ -1,7 +1,15 @@
 import os
+import sys
 import glob
 
-from thumbservice.common import settings, get_temp_filename_prefix
+from thumbservice import metrics
+from thumbservice.cache import LRUFileCache
+from thumbservice.jobs import JOB_STORES
+from thumbservice.common import settings, get_temp_filename_prefix, reset_process_locals
+
+# Import the app, and everything it needs to render, in the master process so that workers share it
+# copy-on-write and start faster: https://docs.gunicorn.org/en/stable/settings.html#preload-app
+preload_app = settings.PRELOAD_APP
 
 
 def clean_up_files(worker_id):
@@ -16,15 +24,60 @@ def child_exit(server, worker):
     # If the worker is not killed gracefully, the temp files generated under
     # that worker will need to be cleaned up
     clean_up_files(worker.pid)
+    metrics.mark_process_dead(settings.METRICS_DIR, worker.pid)
+    # Jobs run on threads of the worker, so those it had not finished never will be
+    if settings.JOB_QUEUE_BACKEND in JOB_STORES:
+        JOB_STORES[settings.JOB_QUEUE_BACKEND](settings).fail_jobs_of_process(worker.pid)
+
+
+def post_fork(server, worker):
+    # Post fork gunicorn server hook: https://docs.gunicorn.org/en/stable/settings.html#post-fork
+    # Clients and connection pools must not be shared with the master process, so make sure
+    # each worker builds its own the first time it needs one
+    reset_process_locals()
+
+
+def post_worker_init(worker):
+    # Post worker init gunicorn server hook: https://docs.gunicorn.org/en/stable/settings.html#post-worker-init
+    # Build the clients of the worker before it accepts requests rather than during its first ones
+    if settings.WARM_UP_WORKERS:
+        from thumbservice import thumbservice
+        thumbservice.warm_up()
+    # Metrics are also written between requests, rather than only after them
+    metrics.REGISTRY.start_flushing(settings.METRICS_DIR, settings.METRICS_FLUSH_INTERVAL)
+
+
+def worker_exit(server, worker):
+    # Worker exit gunicorn server hook: https://docs.gunicorn.org/en/stable/settings.html#worker-exit
+    # Write the final metrics of the worker, which child_exit then keeps as those of a dead process
+    metrics.REGISTRY.stop_flushing()
+    metrics.REGISTRY.flush(settings.METRICS_DIR)
 
 
 def on_starting(server):
     # If the pod is restarted forcefully (for example, for an OOM) then the child exit hook may
     # even have been run. The on starting hook runs when the master process starts. Clear out
-    # the temp dir if there is anything in there.
+    # the temp dir if there is anything in there. Directories, such as a local cache, are kept.
     # https://docs.gunicorn.org/en/stable/settings.html#on-starting
     paths = glob.glob(f'{settings.TMP_DIR}*')
     for path in paths:
-        if os.path.exists(path):
+        if os.path.isfile(path):
             server.log.info(f'Path {path} was left behind during restart, cleaning it up')
             os.remove(path)
+
+    if settings.PRELOAD_APP:
+        from thumbservice import thumbservice
+        thumbservice.preload_rendering()
+
+    # Metrics are reported from the start of this server
+    for path in glob.glob(os.path.join(settings.METRICS_DIR, '*')):
+        os.remove(path)
+
+    # Cached source frames are kept across restarts, but anything left half written is removed and the
+    # cache is trimmed in case its limits were lowered
+    if settings.FRAME_CACHE_MAX_BYTES and os.path.isdir(settings.FRAME_CACHE_DIR):
+        server.log.info(f'Cleaning up frame cache {settings.FRAME_CACHE_DIR}')
+        LRUFileCache(settings.FRAME_CACHE_DIR, settings.FRAME_CACHE_MAX_BYTES, settings.FRAME_CACHE_MAX_ENTRIES).clean_up()
+    if settings.ALIGNMENT_CACHE_MAX_ENTRIES and os.path.isdir(settings.ALIGNMENT_CACHE_DIR):
+        server.log.info(f'Cleaning up alignment cache {settings.ALIGNMENT_CACHE_DIR}')
+        LRUFileCache(settings.ALIGNMENT_CACHE_DIR, sys.maxsize, settings.ALIGNMENT_CACHE_MAX_ENTRIES).clean_up()
@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from thumbservice.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+WORKER_EXITED = {'message': 'The worker running the job exited, try again', 'status_code': 500}
+
+
+class QueueFull(Exception):
+    pass
+
+
+class MemoryJobStore:
+    """Job records kept in the memory of a single process
+
+    Only suitable when status requests are handled by the same process that ran the job.
+    """
+    def __init__(self, ttl, max_entries=10000):
+        self._jobs = TTLCache(max_entries, ttl)
+
+    def create(self, job_id):
+        self._jobs.set(job_id, {'status': PENDING})
+
+    def update(self, job_id, status, result=None):
+        self._jobs.set(job_id, dict(result or {}, status=status))
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def fail_jobs_of_process(self, pid):
+        # The jobs are kept by the process that ran them, so they are gone along with it
+        pass
+
+
+class SQLiteJobStore:
+    """Job records kept in a SQLite database, so any worker process on the host can report on them"""
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        with self._connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT, result TEXT, updated REAL, pid INTEGER)'
+            )
+            # Databases created before jobs recorded the process running them
+            if 'pid' not in [column[1] for column in connection.execute('PRAGMA table_info(jobs)')]:
+                connection.execute('ALTER TABLE jobs ADD COLUMN pid INTEGER')
+
+    def _connect(self):
+        # A connection per call keeps this safe to use from any thread or greenlet
+        return sqlite3.connect(self.path, timeout=10)
+
+    def create(self, job_id):
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute('DELETE FROM jobs WHERE updated < ?', (now - self.ttl,))
+            connection.execute(
+                'INSERT INTO jobs (id, status, result, updated, pid) VALUES (?, ?, ?, ?, ?)',
+                (job_id, PENDING, '{}', now, os.getpid())
+            )
+
+    def update(self, job_id, status, result=None):
+        with self._connect() as connection:
+            connection.execute(
+                'UPDATE jobs SET status = ?, result = ?, updated = ? WHERE id = ?',
+                (status, json.dumps(result or {}), time.time(), job_id)
+            )
+
+    def get(self, job_id):
+        with self._connect() as connection:
+            row = connection.execute(
+                'SELECT status, result FROM jobs WHERE id = ? AND updated >= ?', (job_id, time.time() - self.ttl)
+            ).fetchone()
+        if row is None:
+            return None
+        status, result = row
+        return dict(json.loads(result), status=status)
+
+    def fail_jobs_of_process(self, pid):
+        """Mark the jobs that the process pid had not finished as failed, after it has exited"""
+        with self._connect() as connection:
+            connection.execute(
+                'UPDATE jobs SET status = ?, result = ?, updated = ? WHERE pid = ? AND status IN (?, ?)',
+                (FAILED, json.dumps(WORKER_EXITED), time.time(), pid, PENDING, RUNNING)
+            )
+
+
+JOB_STORES = {
+    'memory': lambda settings: MemoryJobStore(settings.JOB_TTL),
+    'sqlite': lambda settings: SQLiteJobStore(settings.JOB_DB_PATH, settings.JOB_TTL),
+}
+
+
+class JobQueue:
+    """Run jobs on a bounded pool of threads, recording their progress in a job store
+
+    A job is a callable returning a JSON serializable dict. If it raises, the job is marked as failed
+    with the message and status code of the exception, when it has them.
+    """
+    def __init__(self, store, max_workers, max_pending):
+        self.store = store
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, fn):
+        if not self._pending.acquire(blocking=False):
+            raise QueueFull()
+        job_id = uuid.uuid4().hex
+        try:
+            self.store.create(job_id)
+            self._executor.submit(self._run, job_id, fn)
+        except Exception:
+            self._pending.release()
+            raise
+        return job_id
+
+    def _run(self, job_id, fn):
+        try:
+            self.store.update(job_id, RUNNING)
+            result = fn()
+        except Exception as e:
+            logger.warning(f'Job {job_id} failed', exc_info=True)
+            self.store.update(job_id, FAILED, {
+                'message': getattr(e, 'message', 'Failed to generate thumbnail'),
+                'status_code': getattr(e, 'status_code', 500),
+            })
+        else:
+            self.store.update(job_id, DONE, result)
+        finally:
+            self._pending.release()
+
+    def get(self, job_id):
+        return self.store.get(job_id)
@@ -0,0 +1,281 @@
+"""Prometheus style metrics that are aggregated across gunicorn worker processes
+
+Each worker keeps its metrics in memory and periodically writes a snapshot of them to a file named
+after its pid in a shared directory, once more as it exits. The metrics endpoint merges the snapshots of all workers:
+counters and histograms are summed, and gauges are either summed over the live workers, take the
+maximum over all of them, or only use the value of the process serving the request. Snapshots of workers that have exited are kept, so that counters never go
+backwards, but are marked dead so their gauges are no longer counted.
+"""
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from contextlib import ContextDecorator
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+DEAD_PREFIX = 'dead-'
+
+logger = logging.getLogger(__name__)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._last_flush = 0
+        self._stop_flushing = None
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def clear(self):
+        for metric in self.metrics.values():
+            metric.clear()
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def flush(self, directory, min_interval=0):
+        """Write this process's snapshot to directory, at most once every min_interval seconds"""
+        if not directory:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_flush < min_interval:
+                return
+            self._last_flush = now
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{os.getpid()}.json')
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def start_flushing(self, directory, interval):
+        """Flush to directory every interval seconds from a background thread until stop_flushing is called
+
+        Flushing after requests alone would leave whatever changed after the last one unwritten.
+        """
+        if not directory or interval <= 0:
+            return
+        self.stop_flushing()
+        stop = self._stop_flushing = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                try:
+                    self.flush(directory)
+                except OSError:
+                    logger.warning(f'Failed to write metrics to {directory}', exc_info=True)
+        threading.Thread(target=run, name='metrics-flush', daemon=True).start()
+
+    def stop_flushing(self):
+        if self._stop_flushing is not None:
+            self._stop_flushing.set()
+            self._stop_flushing = None
+
+    def collect(self, directory):
+        """Merge the snapshots of every process that has written to directory with this process's own
+
+        The snapshot of this process is always the first one handed to each metric to merge.
+        """
+        snapshots = [(True, self.snapshot())]
+        own_file = f'{os.getpid()}.json'
+        if directory and os.path.isdir(directory):
+            for filename in os.listdir(directory):
+                if filename == own_file or not filename.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(directory, filename)) as f:
+                        snapshots.append((not filename.startswith(DEAD_PREFIX), json.load(f)))
+                except (OSError, ValueError):
+                    continue
+        merged = {}
+        for name, metric in self.metrics.items():
+            merged[name] = metric.merge([(live, snapshot.get(name, {})) for live, snapshot in snapshots])
+        return merged
+
+    def render(self, directory):
+        """Return the merged metrics in the Prometheus text exposition format"""
+        merged = self.collect(directory)
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.type}')
+            lines.extend(metric.render(merged[name]))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def mark_process_dead(directory, pid):
+    """Keep the final snapshot of a process that has exited, without counting its gauges anymore"""
+    path = os.path.join(directory, f'{pid}.json')
+    if directory and os.path.exists(path):
+        os.replace(path, os.path.join(directory, f'{DEAD_PREFIX}{pid}-{uuid.uuid4().hex}.json'))
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} requires labels {", ".join(self.labelnames)}')
+        return json.dumps([str(labels[name]) for name in self.labelnames])
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self._values))
+
+    def render(self, values):
+        return [
+            f'{self.name}{_format_labels(self.labelnames, json.loads(key))} {_format_value(value)}'
+            for key, value in sorted(values.items())
+        ]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def merge(self, snapshots):
+        merged = {}
+        for _, values in snapshots:
+            for key, value in values.items():
+                merged[key] = merged.get(key, 0) + value
+        return merged
+
+
+class Gauge(Metric):
+    """A value that can go up and down, merged with 'livesum', 'max' or 'local' across processes"""
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, aggregate='livesum'):
+        self.aggregate = aggregate
+        super().__init__(name, documentation, labelnames, registry)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def merge(self, snapshots):
+        if self.aggregate == 'local':
+            return dict(snapshots[0][1])
+        merged = {}
+        for live, values in snapshots:
+            for key, value in values.items():
+                if self.aggregate == 'max':
+                    merged[key] = max(merged.get(key, value), value)
+                elif live:
+                    merged[key] = merged.get(key, 0) + value
+        return merged
+
+
+class _Timer(ContextDecorator):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def _recreate_cm(self):
+        # Each call of a decorated function needs its own start time
+        return _Timer(self.histogram, self.labels)
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.monotonic() - self.start, **self.labels)
+        return False
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        if self.buckets[-1] != float('inf'):
+            self.buckets += (float('inf'),)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.setdefault(key, {'buckets': [0] * len(self.buckets), 'sum': 0, 'count': 0})
+            for index, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    entry['buckets'][index] += 1
+                    break
+            entry['sum'] += value
+            entry['count'] += 1
+
+    def time(self, **labels):
+        """Observe the duration of a block of code, usable as a context manager or decorator"""
+        return _Timer(self, labels)
+
+    def merge(self, snapshots):
+        merged = {}
+        for _, values in snapshots:
+            for key, value in values.items():
+                entry = merged.setdefault(key, {'buckets': [0] * len(self.buckets), 'sum': 0, 'count': 0})
+                entry['buckets'] = [a + b for a, b in zip(entry['buckets'], value['buckets'])]
+                entry['sum'] += value['sum']
+                entry['count'] += value['count']
+        return merged
+
+    def render(self, values):
+        lines = []
+        for key, entry in sorted(values.items()):
+            labelvalues = json.loads(key)
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets, entry['buckets']):
+                cumulative += count
+                labels = _format_labels(self.labelnames, labelvalues, [('le', _format_value(upper_bound))])
+                lines.append(f'{self.name}_bucket{labels} {_format_value(cumulative)}')
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f'{self.name}_sum{labels} {_format_value(entry["sum"])}')
+            lines.append(f'{self.name}_count{labels} {_format_value(entry["count"])}')
+        return lines
@@ -0,0 +1,198 @@
+import os
+import logging
+
+import numpy as np
+from PIL import Image
+from astropy.io import fits
+from fits2image.conversions import _add_label
+from fits2image.scaling import extract_samples, calc_zscale_min_max, linear_scale, recalculate_median, stack_images
+
+logger = logging.getLogger(__name__)
+
+ZSCALE_SAMPLES = 2000
+PREVIEW_SAMPLES = 10000
+# Reading the rows of a compressed image one at a time has a fixed cost per row, so it is only
+# faster than decompressing every tile when most of the rows are skipped
+ROW_READ_MIN_STEP = 8
+
+
+def preview_step(shape, width, height):
+    """Return the largest stride that still reads at least twice the resolution of the thumbnail"""
+    return max(1, min(shape[0] // (2 * height), shape[1] // (2 * width)))
+
+
+def read_strided(hdu, step):
+    if not hasattr(hdu, 'section'):
+        # Compressed HDUs only have a section from astropy 5.3, so older versions decompress it all
+        return hdu.data[::step, ::step]
+    tile_shape = getattr(hdu, 'tile_shape', None)
+    if tile_shape is not None and tile_shape[0] == 1 and step >= ROW_READ_MIN_STEP:
+        # Each row is a tile of its own, so only the rows that are kept need to be decompressed
+        return np.stack([hdu.section[row, ::step] for row in range(0, hdu.shape[0], step)])
+    return hdu.section[::step, ::step]
+
+
+def read_image_data(source, preview_size=None):
+    """Return the data and header of the first 2D image in a FITS file, given as a path or file object
+
+    Tile compressed data is decompressed straight from the file object, so a frame that has been
+    downloaded into memory never needs to be written to disk. If the (width, height) of a preview
+    is given, only every nth pixel needed for that size is read.
+    """
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    with fits.open(source, memmap=False) as hdul:
+        for hdu in hdul:
+            # Sinistro frames have an empty primary HDU followed by one HDU per quadrant
+            if hdu.is_image and len(hdu.shape) == 2 and hdu.shape[0] > 0:
+                if preview_size is None:
+                    return hdu.data, hdu.header
+                return read_strided(hdu, preview_step(hdu.shape, *preview_size)), hdu.header
+    raise ValueError('No FITS image data found')
+
+
+def scale_image(data, header, contrast=0.1, gamma_adjust=2.5, percentile=99.5, median=False):
+    """Scale the data to 8 bits the same way as fits2image, returning an image flipped the right way up"""
+    samples = extract_samples(data, header, ZSCALE_SAMPLES)
+    zmin, zmax, _ = calc_zscale_min_max(samples, contrast=contrast, iterations=1)
+    scaled_data = linear_scale(data, np.median(samples), zmax, gamma_adjust=gamma_adjust)
+    if median:
+        scaled_data = recalculate_median(scaled_data, percentile)
+    return Image.fromarray(scaled_data).transpose(Image.FLIP_TOP_BOTTOM)
+
+
+def recalculate_median_from_sample(data, percentile, samples):
+    """recalculate_median from fits2image, with the median and percentile taken from samples of the data"""
+    median = np.median(samples)
+    max_val = np.percentile(np.clip(samples - median, 0, None), percentile) or 1
+    data = data.astype('float')
+    data -= median
+    data.clip(0, None, data)
+    data *= 255. / max_val
+    data.clip(None, 255., data)
+    return data.astype('uint8')
+
+
+def scale_preview_image(data, contrast=0.1, gamma_adjust=2.5, percentile=99.5, median=False):
+    """Scale the data like scale_image, with the limits taken from random samples instead of every pixel"""
+    # A fixed seed renders the same preview every time
+    rng = np.random.default_rng(0)
+    samples = np.sort(rng.choice(data.ravel(), ZSCALE_SAMPLES))
+    zmin, zmax, _ = calc_zscale_min_max(samples, contrast=contrast, iterations=1)
+    scaled_data = linear_scale(data, np.median(samples), zmax, gamma_adjust=gamma_adjust)
+    if median:
+        scaled_data = recalculate_median_from_sample(scaled_data, percentile, rng.choice(scaled_data.ravel(), PREVIEW_SAMPLES))
+    return Image.fromarray(scaled_data).transpose(Image.FLIP_TOP_BOTTOM)
+
+
+def thumbnail_coordinates(frame_size, thumbnail_size):
+    """Return the matrix taking the pixel coordinates of a frame to those of its thumbnail, which is flipped"""
+    (frame_width, frame_height), (thumbnail_width, thumbnail_height) = frame_size, thumbnail_size
+    scale_x, scale_y = thumbnail_width / frame_width, thumbnail_height / frame_height
+    flip = np.array([[1, 0, 0], [0, -1, frame_height - 1], [0, 0, 1]])
+    # Pixel centers line up, rather than the corners of the first pixels
+    scale = np.array([[scale_x, 0, (scale_x - 1) / 2], [0, scale_y, (scale_y - 1) / 2], [0, 0, 1]])
+    return scale @ flip
+
+
+def align_thumbnails(thumbnails, frame_sizes, transforms):
+    """Warp thumbnails onto the first one, given the transforms that map each of their frames onto its frame
+
+    Transforms are fits_align SimpleTransforms in frame pixel coordinates, or None for no transform.
+    Warping thumbnails rather than frames means resampling only as many pixels as the output has.
+    """
+    reference_coordinates = thumbnail_coordinates(frame_sizes[0], thumbnails[0].size)
+    aligned = []
+    for thumbnail, frame_size, transform in zip(thumbnails, frame_sizes, transforms):
+        if transform is None:
+            aligned.append(thumbnail)
+            continue
+        # PIL maps each output pixel back to the input pixel it is sampled from, so the transform is inverted
+        matrix, offset = transform.inverse().matrixform()
+        frame_affine = np.array([[matrix[0][0], matrix[0][1], offset[0]], [matrix[1][0], matrix[1][1], offset[1]], [0, 0, 1]])
+        affine = thumbnail_coordinates(frame_size, thumbnail.size) @ frame_affine @ np.linalg.inv(reference_coordinates)
+        aligned.append(thumbnail.transform(thumbnails[0].size, Image.AFFINE, tuple(affine[:2].ravel()), resample=Image.BILINEAR))
+    return aligned
+
+
+def fits_to_image(sources, width, height, contrast=0.1, gamma_adjust=2.5, color=False, percentile=99.5,
+                  median=False, preview=False, transforms=None):
+    """Return the scaled image of one FITS file, or of three RVB FITS files when color is set
+
+    The image is at least large enough for a thumbnail of width and height.
+    """
+    images = []
+    frame_sizes = []
+    for source in sources:
+        if preview:
+            data, header = read_image_data(source, preview_size=(width, height))
+            images.append(scale_preview_image(data, contrast=contrast, gamma_adjust=gamma_adjust, percentile=percentile, median=median))
+        else:
+            data, header = read_image_data(source)
+            images.append(scale_image(data, header, contrast=contrast, gamma_adjust=gamma_adjust, percentile=percentile, median=median))
+        frame_sizes.append((header['NAXIS1'], header['NAXIS2']))
+    if not color:
+        return images[0]
+    if len(images) != 3:
+        raise ValueError('Need exactly 3 FITS files (RVB) to create a color jpg')
+    if transforms is not None:
+        for image in images:
+            image.thumbnail((width, height), Image.LANCZOS)
+        images = align_thumbnails(images, frame_sizes, transforms)
+    return stack_images(images)
+
+
+def save_jpg(image, jpg_path, label_text='', label_font='DejaVuSansMono.ttf', quality=95, progressive=False):
+    """Save the image as a jpg to a path or a file object"""
+    if label_text:
+        image = image.copy()
+        try:
+            _add_label(image, label_text, label_font)
+        except IOError:
+            logger.warning(f'Font {label_font} could not be found, ignoring label text')
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if isinstance(jpg_path, str):
+        os.makedirs(os.path.dirname(jpg_path) or '.', exist_ok=True)
+    image.save(jpg_path, 'jpeg', quality=quality, progressive=progressive)
+
+
+def fits_to_jpg(sources, jpg_path, width=200, height=200, progressive=False, label_text='',
+                label_font='DejaVuSansMono.ttf', contrast=0.1, gamma_adjust=2.5, quality=95, color=False,
+                percentile=99.5, median=False, preview=False, transforms=None):
+    """Write a jpg of one FITS file, or of three RVB FITS files when color is set
+
+    Takes the same arguments as fits2image.conversions.fits_to_jpg, but the FITS files and the jpg may
+    be given as file objects as well as paths. Setting preview trades quality for speed by reading only as many
+    pixels as the thumbnail needs and scaling them using samples of the pixels. Color images are
+    aligned in memory if transforms, as taken by align_thumbnails, are given for each of the sources.
+    """
+    fits_to_jpgs(
+        sources, [(jpg_path, width, height)], progressive=progressive, label_text=label_text, label_font=label_font,
+        contrast=contrast, gamma_adjust=gamma_adjust, quality=quality, color=color, percentile=percentile,
+        median=median, preview=preview, transforms=transforms
+    )
+
+
+def fits_to_jpgs(sources, renditions, progressive=False, label_text='', label_font='DejaVuSansMono.ttf',
+                 contrast=0.1, gamma_adjust=2.5, quality=95, color=False, percentile=99.5, median=False,
+                 preview=False, transforms=None):
+    """Write a jpg for each (jpg_path, width, height) in renditions, decoding and scaling the FITS files once
+
+    Each rendition is shrunk from the next larger one, so every pixel of the frame is only resampled
+    once. The other arguments are the same as for fits_to_jpg.
+    """
+    max_width = max(width for _, width, _ in renditions)
+    max_height = max(height for _, _, height in renditions)
+    image = fits_to_image(
+        sources, max_width, max_height, contrast=contrast, gamma_adjust=gamma_adjust, color=color,
+        percentile=percentile, median=median, preview=preview, transforms=transforms
+    )
+    # Thumbnails keep the aspect ratio of the image, so their size is set by whichever of width and
+    # height shrinks it the most, not by the area asked for
+    renditions = sorted(
+        renditions, key=lambda rendition: min(rendition[1] / image.width, rendition[2] / image.height), reverse=True
+    )
+    for jpg_path, width, height in renditions:
+        image.thumbnail((width, height), Image.LANCZOS)
+        save_jpg(image, jpg_path, label_text=label_text, label_font=label_font, quality=quality, progressive=progressive)
@@ -1,3 +1,11 @@
+import io
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+import concurrent.futures
 from unittest import mock
 from pathlib import Path
 from copy import deepcopy
@@ -6,10 +14,21 @@ from collections import namedtuple
 import boto3
 import pytest
 import requests
+import numpy as np
+from PIL import Image
 from moto import mock_s3
+from astropy.io import fits
+from fits_align.star import SimpleTransform
 
+from thumbservice import cache
 from thumbservice import common
+from thumbservice import config
+from thumbservice import concurrency
+from thumbservice import jobs
+from thumbservice import metrics
+from thumbservice import render
 from thumbservice import thumbservice
+from thumbservice import uploads
 
 TEST_API_URL = 'https://test-archive-api.lco.gtn/'
 TEST_BUCKET = 'test-bucket'
@@ -95,42 +114,40 @@ _test_data = {
 
 
 @pytest.fixture(autouse=True)
-def set_test_values(tmp_path):
+def set_test_values(tmp_path, tmp_path_factory):
     thumbservice.settings = common.Settings(
         settings={
             'TMP_DIR': tmp_path,
+            'METRICS_DIR': str(tmp_path_factory.mktemp('metrics')),
             'ARCHIVE_API_URL': TEST_API_URL,
             'AWS_BUCKET': TEST_BUCKET,
             'AWS_ACCESS_KEY_ID': TEST_ACCESS_KEY,
-            'AWS_SECRET_ACCESS_KEY': TEST_SECRET_ACCESS_KEY
+            'AWS_SECRET_ACCESS_KEY': TEST_SECRET_ACCESS_KEY,
+            'ALIGNMENT_CACHE_MAX_ENTRIES': 0,
+            'ARCHIVE_CACHE_MAX_ENTRIES': 0,
         }
     )
+    # Clients must be created inside of the mocks set up for each test
+    common.reset_process_locals()
+    metrics.REGISTRY.clear()
+    yield
+    # Uploads still in the background would otherwise land in the bucket of the next test
+    thumbservice.upload_queue.get().shutdown()
+    common.reset_process_locals()
 
 
 @pytest.fixture(autouse=True)
 def mock_fits_to_jpeg():
     def side_effect(*args, **kwargs):
-        Path(args[1]).touch()
+        args[1].write(b'I Am Thumbnail')
     m = thumbservice.fits_to_jpg = mock.MagicMock()
     m.side_effect = side_effect
 
-
-def make_tmp_file(tmp_path, filename, suffix):
-    path = tmp_path / Path(filename).with_suffix(suffix)
-    path.touch()
-    return str(path)
-
-
-@pytest.fixture(autouse=True)
-def mock_affineremap(tmp_path, request):
-    if 'no_auto_mock_affineremap' in request.keywords:
-        return
-
-    def side_effect(*args, **kwargs):
-        return make_tmp_file(tmp_path, args[0], '.affineremap')
-
-    m = thumbservice.affineremap = mock.MagicMock()
-    m.side_effect = side_effect
+    def renditions_side_effect(*args, **kwargs):
+        for jpg, _, _ in args[1]:
+            jpg.write(b'I Am Thumbnail')
+    m = thumbservice.fits_to_jpgs = mock.MagicMock()
+    m.side_effect = renditions_side_effect
 
 
 def make_transforms_returns(paths, is_ok):
@@ -138,7 +155,7 @@ def make_transforms_returns(paths, is_ok):
     result = namedtuple('Result', ['ok', 'trans', 'ukn'])
     results = []
     for path in paths:
-        results.append(result(is_ok, None, ukn(path)))
+        results.append(result(is_ok, SimpleTransform() if is_ok else None, ukn(path)))
     return results
 
 
@@ -168,6 +185,8 @@ def s3_client():
         s3 = boto3.client('s3', aws_access_key_id=TEST_ACCESS_KEY, aws_secret_access_key=TEST_SECRET_ACCESS_KEY, config=config)
         s3.create_bucket(Bucket=TEST_BUCKET)
         yield s3
+        # Finish background uploads while S3 is still mocked
+        thumbservice.upload_queue.get().shutdown()
 
 
 def test_get_index(thumbservice_client):
@@ -225,10 +244,9 @@ def test_generate_color_thumbnail_successfully(thumbservice_client, requests_moc
     assert len(list(tmp_path.glob('*'))) == 0
 
 
-@pytest.mark.no_auto_mock_affineremap
 def test_image_align_fails_falls_back_to_original_image_list(thumbservice_client, requests_mock, tmp_path, s3_client):
-    m = thumbservice.affineremap = mock.MagicMock()
-    m.side_effect = [make_tmp_file(tmp_path, 'tmp', '.fits'), Exception('Something bad happened')]
+    m = thumbservice.make_transforms = mock.MagicMock()
+    m.side_effect = Exception('Something bad happened')
     frame = deepcopy(_test_data['frame'])
     request_frames = deepcopy(_test_data['request_frames'])
     requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
@@ -240,13 +258,14 @@ def test_image_align_fails_falls_back_to_original_image_list(thumbservice_client
     assert 'url' in response_as_json
     assert response_as_json['propid'] == frame['proposal_id']
     assert response.status_code == 200
+    assert thumbservice.fits_to_jpg.call_args.kwargs['transforms'] is None
     assert len(list(tmp_path.glob('*'))) == 0
 
 
 @pytest.mark.mock_make_transforms
 def test_one_image_doesnt_align_falls_back_to_original_image_list(thumbservice_client, requests_mock, tmp_path, s3_client):
     m = thumbservice.make_transforms = mock.MagicMock()
-    m.side_effect = [make_transforms_returns(['a.fits'], True), make_transforms_returns(['b.fits'], False)]
+    m.side_effect = [make_transforms_returns(['a.fits'], True) + make_transforms_returns(['b.fits'], False)]
     frame = deepcopy(_test_data['frame'])
     request_frames = deepcopy(_test_data['request_frames'])
     requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
@@ -258,9 +277,62 @@ def test_one_image_doesnt_align_falls_back_to_original_image_list(thumbservice_c
     assert 'url' in response_as_json
     assert response_as_json['propid'] == frame['proposal_id']
     assert response.status_code == 200
+    assert thumbservice.fits_to_jpg.call_args.kwargs['transforms'] is None
     assert len(list(tmp_path.glob('*'))) == 0
 
 
+def test_alignment_is_reused_by_other_color_thumbnails(thumbservice_client, requests_mock, s3_client, tmp_path):
+    thumbservice.settings.ALIGNMENT_CACHE_MAX_ENTRIES = 10
+    thumbservice.make_transforms.side_effect = lambda ref, ukns: [
+        make_transforms_returns(ukns[:1], True)[0]._replace(trans=SimpleTransform((1, 0, 3, 4))),
+        make_transforms_returns(ukns[1:], True)[0],
+    ]
+    frame = deepcopy(_test_data['frame'])
+    request_frames = deepcopy(_test_data['request_frames'])
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(f'{TEST_API_URL}frames/?request_id={frame["request_id"]}&reduction_level=91', json=request_frames)
+    for request_frame in request_frames['results']:
+        requests_mock.get(request_frame['url'], content=b'I Am Image')
+    sources = []
+
+    def side_effect(*args, **kwargs):
+        sources.append([isinstance(source, str) for source in args[0]])
+        args[1].write(b'I Am Thumbnail')
+    thumbservice.fits_to_jpg.side_effect = side_effect
+    assert thumbservice_client.get(f'/{frame["id"]}/?color=true&width=200').status_code == 200
+    assert thumbservice_client.get(f'/{frame["id"]}/?color=true&width=500').status_code == 200
+    assert thumbservice.make_transforms.call_count == 1
+    transforms = thumbservice.fits_to_jpg.call_args.kwargs['transforms']
+    assert transforms[0] is None
+    assert list(transforms[1].v) == [1, 0, 3, 4]
+    assert list(transforms[2].v) == [1, 0, 0, 0]
+    # Frames are only downloaded to disk when they have to be aligned
+    assert sources == [[True] * 3, [False] * 3]
+    assert [path.name for path in tmp_path.glob('*')] == ['alignment-cache']
+    assert [path.name for path in (tmp_path / 'alignment-cache').glob('*')] == ['11245105-11245120-11245132.json']
+
+
+def test_color_frames_are_aligned_in_memory(tmp_path):
+    sizes = [(60, 40), (60, 40), (120, 80)]
+    paths = []
+    for index, (width, height) in enumerate(sizes):
+        data = np.zeros((height, width), dtype=np.float32)
+        # A single bright pixel, at (10, 8) on the red frame, (13, 6) on the visual frame and (20, 16) on the blue
+        x, y = [(10, 8), (13, 6), (20, 16)][index]
+        data[y, x] = 1000
+        data[0, 0] = 1
+        paths.append(str(tmp_path / f'{index}.fits'))
+        fits.PrimaryHDU(data).writeto(paths[-1])
+    transforms = [None, SimpleTransform((1, 0, -3, 2)), SimpleTransform((0.5, 0, 0, 0))]
+    jpg_path = str(tmp_path / 'color.jpg')
+    render.fits_to_jpg(paths, jpg_path, width=60, height=40, color=True, transforms=transforms, quality=100)
+    with Image.open(jpg_path) as image:
+        pixels = np.asarray(image)
+    # Each channel's brightest pixel is where the red one is, flipped the right way up
+    for channel in range(3):
+        assert np.unravel_index(np.argmax(pixels[:, :, channel]), pixels.shape[:2]) == (40 - 1 - 8, 10)
+
+
 def test_all_filters_for_color_thumbnail_not_available(thumbservice_client, requests_mock, s3_client, tmp_path):
     frame = deepcopy(_test_data['frame'])
     request_frames = deepcopy(_test_data['request_frames'])
@@ -371,3 +443,804 @@ def test_frame_basename_does_not_exist(thumbservice_client, requests_mock, tmp_p
     response = thumbservice_client.get('/some_frame_that_doesnt_exist/')
     assert response.status_code == 404
     assert len(list(tmp_path.glob('*'))) == 0
+
+
+def test_frame_is_streamed_to_disk_in_chunks(requests_mock, tmp_path):
+    thumbservice.settings.DOWNLOAD_CHUNK_SIZE = 4
+    frame = deepcopy(_test_data['frame'])
+    requests_mock.get(frame['url'], content=b'I Am Image')
+    path = thumbservice.save_temp_file(frame)
+    assert Path(path).read_bytes() == b'I Am Image'
+    assert Path(path).parent == tmp_path
+
+
+def test_black_and_white_frame_is_decoded_from_memory(thumbservice_client, requests_mock, s3_client, tmp_path):
+    sources = []
+
+    def side_effect(*args, **kwargs):
+        sources.append((isinstance(args[0][0], str), args[0][0].read(), len(list(tmp_path.glob('*.fits*')))))
+        args[1].write(b'I Am Thumbnail')
+    thumbservice.fits_to_jpg.side_effect = side_effect
+    frame = deepcopy(_test_data['frame'])
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(frame['url'], content=b'I Am Image')
+    response = thumbservice_client.get(f'/{frame["id"]}/')
+    assert response.status_code == 200
+    # The frame was handed over as a file object, and had not been written to the temp dir
+    assert sources == [(False, b'I Am Image', 0)]
+    assert len(list(tmp_path.glob('*'))) == 0
+
+
+def test_large_frame_spills_over_to_an_anonymous_file(requests_mock, tmp_path):
+    thumbservice.settings.IN_MEMORY_DECODE_MAX_BYTES = 4
+    frame = deepcopy(_test_data['frame'])
+    requests_mock.get(frame['url'], content=b'I Am Image')
+    with thumbservice.download_to_buffer(frame) as buffer:
+        assert buffer._rolled
+        assert buffer.read() == b'I Am Image'
+        assert len(list(tmp_path.glob('*'))) == 0
+
+
+def test_cancelled_download_to_memory_stops(requests_mock):
+    frame = deepcopy(_test_data['frame'])
+    requests_mock.get(frame['url'], content=b'I Am Image')
+    cancel_event = threading.Event()
+    cancel_event.set()
+    with pytest.raises(thumbservice.DownloadCancelled):
+        thumbservice.download_to_buffer(frame, cancel_event)
+
+
+def test_jpg_is_rendered_from_fits_in_memory(tmp_path):
+    data = np.random.default_rng(0).normal(1000, 30, (64, 48)).astype(np.float32)
+    buffer = io.BytesIO()
+    fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data)]).writeto(buffer)
+    jpg_path = str(tmp_path / 'thumbnail.jpg')
+    render.fits_to_jpg([buffer], jpg_path, width=32, height=32)
+    with Image.open(jpg_path) as image:
+        assert image.format == 'JPEG'
+        assert image.size == (24, 32)
+
+
+def test_renditions_of_a_non_square_request_are_each_their_own_size():
+    data = np.random.default_rng(0).normal(1000, 30, (400, 400)).astype(np.float32)
+    buffer = io.BytesIO()
+    fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data)]).writeto(buffer)
+    jpgs = [io.BytesIO() for _ in range(3)]
+    render.fits_to_jpgs([buffer], [(jpgs[0], 1000, 50), (jpgs[1], 200, 200), (jpgs[2], 100, 100)])
+    sizes = []
+    for jpg in jpgs:
+        with Image.open(io.BytesIO(jpg.getvalue())) as image:
+            sizes.append(image.size)
+    assert sizes == [(50, 50), (200, 200), (100, 100)]
+
+
+def test_jpg_is_rendered_in_a_render_process():
+    thumbservice.settings.RENDER_EXECUTOR = 'process'
+    thumbservice.settings.RENDER_PROCESSES = 1
+    data = np.random.default_rng(0).normal(1000, 30, (64, 48)).astype(np.float32)
+    buffer = io.BytesIO()
+    fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data)]).writeto(buffer)
+    try:
+        jpg = thumbservice.convert_to_jpg([buffer], thumbservice.Paths(), width=32, height=32)
+    finally:
+        thumbservice.render_executor.get().shutdown()
+    # The render process has its own copy of the module, without the mocks of this one
+    assert thumbservice.fits_to_jpg.call_count == 0
+    with Image.open(io.BytesIO(jpg)) as image:
+        assert image.format == 'JPEG'
+        assert image.size == (24, 32)
+
+
+def test_spilled_frame_is_sent_to_a_render_process_as_a_path(tmp_path):
+    thumbservice.settings.RENDER_EXECUTOR = 'process'
+    thumbservice.settings.RENDER_PROCESSES = 1
+    thumbservice.settings.IN_MEMORY_DECODE_MAX_BYTES = 16
+    paths = thumbservice.Paths()
+    try:
+        sources = thumbservice.sendable_sources([io.BytesIO(b'I Am Image I Am Image'), io.BytesIO(b'I Am Image')], paths)
+    finally:
+        thumbservice.render_executor.get().shutdown()
+    assert sources[0] in paths.all_paths
+    assert Path(sources[0]).read_bytes() == b'I Am Image I Am Image'
+    assert sources[1] == b'I Am Image'
+    paths.clean_up()
+    assert len(list(tmp_path.glob('*'))) == 0
+
+
+@pytest.mark.parametrize('tile_shape', [(1, 400), (50, 50)])
+def test_preview_reads_only_the_pixels_needed_for_its_size(tile_shape):
+    data = np.arange(400 * 400, dtype=np.float32).reshape(400, 400)
+    buffer = io.BytesIO()
+    fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data, tile_shape=tile_shape)]).writeto(buffer)
+    preview, _ = render.read_image_data(buffer, preview_size=(20, 20))
+    np.testing.assert_array_equal(preview, data[::10, ::10])
+
+
+def test_preview_without_sections_reads_strided_data():
+    data = np.arange(400 * 400, dtype=np.float32).reshape(400, 400)
+    # Compressed HDUs of astropy before 5.3 have data but no section
+    hdu = namedtuple('CompImageHDU', ['data', 'shape'])(data, data.shape)
+    np.testing.assert_array_equal(render.read_strided(hdu, 10), data[::10, ::10])
+
+
+def test_progressive_thumbnails_are_stored_separately(thumbservice_client, requests_mock, s3_client):
+    frame = deepcopy(_test_data['frame'])
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(frame['url'], content=b'I Am Image')
+    response = thumbservice_client.get(f'/{frame["id"]}/?image=true&progressive=true')
+    assert response.status_code == 200
+    assert thumbservice.fits_to_jpg.call_args.kwargs['progressive'] is True
+    assert thumbservice.key_for_jpeg(frame['id'], **thumbservice.get_params({'progressive': 'true'})) != \
+        thumbservice.key_for_jpeg(frame['id'], **thumbservice.get_params({}))
+
+
+def test_preview_thumbnails_are_stored_separately(thumbservice_client, requests_mock, s3_client):
+    frame = deepcopy(_test_data['frame'])
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(frame['url'], content=b'I Am Image')
+    thumbservice_client.get(f'/{frame["id"]}/')
+    thumbservice_client.get(f'/{frame["id"]}/?preview=true')
+    assert thumbservice.fits_to_jpg.call_count == 2
+    assert 'preview' not in thumbservice.fits_to_jpg.call_args_list[0].kwargs
+    assert thumbservice.fits_to_jpg.call_args_list[1].kwargs['preview'] is True
+    keys = [obj['Key'] for obj in s3_client.list_objects_v2(Bucket=TEST_BUCKET)['Contents']]
+    assert len(set(keys)) == 2
+
+
+def test_renditions_are_generated_from_one_decode(thumbservice_client, requests_mock, s3_client, tmp_path):
+    thumbservice.settings.RENDITION_SIZES = (200, 500, 1000)
+    frame = deepcopy(_test_data['frame'])
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(frame['url'], content=b'I Am Image')
+    response = thumbservice_client.get(f'/{frame["id"]}/?width=300&height=300&renditions=true')
+    assert response.status_code == 200
+    assert thumbservice.fits_to_jpg.call_count == 0
+    assert thumbservice.fits_to_jpgs.call_count == 1
+    sizes = [(width, height) for _, width, height in thumbservice.fits_to_jpgs.call_args.args[1]]
+    assert sizes == [(300, 300), (200, 200), (500, 500), (1000, 1000)]
+    # The other sizes are uploaded in the background
+    for size in (200, 500, 1000):
+        params = thumbservice.get_params({'width': size, 'height': size})
+        thumbservice.upload_queue.get().wait(thumbservice.key_for_jpeg(frame['id'], **params))
+    keys = [obj['Key'] for obj in s3_client.list_objects_v2(Bucket=TEST_BUCKET)['Contents']]
+    assert len(set(keys)) == 4
+    for size in (200, 500, 1000):
+        response = thumbservice_client.get(f'/{frame["id"]}/?width={size}&height={size}')
+        assert response.status_code == 200
+    assert thumbservice.fits_to_jpgs.call_count == 1
+    assert thumbservice.fits_to_jpg.call_count == 0
+    assert requests_mock.call_count == 5
+    assert len(list(tmp_path.glob('*.jpg'))) == 0
+
+
+def test_image_is_served_directly_with_caching_headers(thumbservice_client, requests_mock, s3_client):
+    thumbservice.settings.DIRECT_IMAGE_RESPONSES = True
+    frame = deepcopy(_test_data['frame'])
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(frame['url'], content=b'I Am Image')
+    response = thumbservice_client.get(f'/{frame["id"]}/?image=true')
+    assert response.status_code == 200
+    assert response.data == b'I Am Thumbnail'
+    assert response.last_modified is not None
+    assert 'public' in response.headers['Cache-Control']
+    etag = response.headers['ETag']
+    assert thumbservice_client.get(f'/{frame["id"]}/?image=true').headers['ETag'] == etag
+    response = thumbservice_client.get(f'/{frame["id"]}/?image=true', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert thumbservice.fits_to_jpg.call_count == 1
+    response = thumbservice_client.get(f'/{frame["id"]}/?image=true', headers={'Authorization': 'Token alice'})
+    assert 'private' in response.headers['Cache-Control']
+    assert response.headers['Vary'] == 'Authorization'
+
+
+def test_frame_larger_than_max_download_size_is_rejected(thumbservice_client, requests_mock, s3_client, tmp_path):
+    thumbservice.settings.MAX_DOWNLOAD_BYTES = 5
+    frame = deepcopy(_test_data['frame'])
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(frame['url'], content=b'I Am Image')
+    response = thumbservice_client.get(f'/{frame["id"]}/')
+    assert response.status_code == 400
+    assert 'Cannot generate thumbnails from frames adding up to more than 5 bytes' in response.get_json()['message']
+    assert len(list(tmp_path.glob('*'))) == 0
+
+
+def test_color_frames_adding_up_to_more_than_max_download_size_are_rejected(thumbservice_client, requests_mock, s3_client, tmp_path):
+    # Each frame is under the limit, but the three of them are not
+    thumbservice.settings.MAX_DOWNLOAD_BYTES = 25
+    frame = deepcopy(_test_data['frame'])
+    request_frames = deepcopy(_test_data['request_frames'])
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(f'{TEST_API_URL}frames/?request_id={frame["request_id"]}&reduction_level=91', json=request_frames)
+    for request_frame in request_frames['results']:
+        requests_mock.get(request_frame['url'], content=b'I Am Image')
+    response = thumbservice_client.get(f'/{frame["id"]}/?color=true')
+    assert response.status_code == 400
+    assert len(list(tmp_path.glob('*'))) == 0
+
+
+def test_batch_frames_adding_up_to_more_than_max_download_size_are_rejected(thumbservice_client, requests_mock, s3_client):
+    thumbservice.settings.MAX_DOWNLOAD_BYTES = 15
+    frame = deepcopy(_test_data['frame'])
+    other_frame = deepcopy(_test_data['request_frames']['results'][2])
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(f'{TEST_API_URL}frames/{other_frame["id"]}/', json=other_frame)
+    requests_mock.get(frame['url'], content=b'I Am Image')
+    requests_mock.get(other_frame['url'], content=b'I Am Image')
+    response = thumbservice_client.post('/batch/', json={'frame_ids': [frame['id'], other_frame['id']]})
+    results = response.get_json()['frame_ids'].values()
+    assert sorted(result.get('status_code', 200) for result in results) == [200, 400]
+
+
+def test_failed_color_frame_download_cleans_up_other_frames(thumbservice_client, requests_mock, s3_client, tmp_path):
+    frame = deepcopy(_test_data['frame'])
+    request_frames = deepcopy(_test_data['request_frames'])
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(f'{TEST_API_URL}frames/?request_id={frame["request_id"]}&reduction_level=91', json=request_frames)
+    for request_frame in request_frames['results']:
+        requests_mock.get(request_frame['url'], content=b'I Am Image')
+    requests_mock.get(request_frames['results'][2]['url'], status_code=500)
+    response = thumbservice_client.get(f'/{frame["id"]}/?color=true')
+    assert response.status_code == 502
+    assert len(list(tmp_path.glob('*'))) == 0
+
+
+def test_color_frames_are_returned_in_rvb_order(requests_mock, tmp_path):
+    frames = thumbservice.rvb_frames(deepcopy(_test_data['request_frames'])['results'])
+    for frame in frames:
+        requests_mock.get(frame['url'], content=frame['primary_optical_element'].encode())
+    paths = thumbservice.Paths()
+    result = thumbservice.fetch_frames(frames, paths)
+    assert [Path(path).read_bytes() for path in result] == [b'rp', b'V', b'B']
+    paths.clean_up()
+    assert len(list(tmp_path.glob('*'))) == 0
+
+
+def test_rendering_is_imported_on_first_use():
+    code = 'import sys; from thumbservice import thumbservice; print("astropy" in sys.modules, "fits_align" in sys.modules)'
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+    assert output.split() == ['False', 'False']
+
+
+def test_s3_client_is_reused_until_reset(s3_client):
+    client = thumbservice.get_s3_client()
+    assert thumbservice.get_s3_client() is client
+    common.reset_process_locals()
+    assert thumbservice.get_s3_client() is not client
+
+
+def test_archive_requests_use_connect_and_read_timeouts(requests_mock):
+    thumbservice.settings.HTTP_CONNECT_TIMEOUT = 2
+    thumbservice.settings.HTTP_READ_TIMEOUT = 30
+    requests_mock.get(f'{TEST_API_URL}frames/1/', json={})
+    thumbservice.get_response(f'{TEST_API_URL}frames/1/')
+    assert requests_mock.last_request.timeout == (2, 30)
+
+
+def test_http_session_is_reused_and_retries_server_errors():
+    session = thumbservice.http_session.get()
+    assert thumbservice.http_session.get() is session
+    retries = session.get_adapter(TEST_API_URL).max_retries
+    assert retries.total == thumbservice.settings.HTTP_RETRIES
+    assert 503 in retries.status_forcelist
+
+
+def test_image_is_served_from_local_cache_after_being_generated(thumbservice_client, requests_mock, s3_client, tmp_path, tmp_path_factory):
+    thumbservice.settings.LOCAL_CACHE_DIR = str(tmp_path_factory.mktemp('cache'))
+    frame = deepcopy(_test_data['frame'])
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(frame['url'], content=b'I Am Image')
+    response1 = thumbservice_client.get(f'/{frame["id"]}/?image=true')
+    # Waiting for the upload threads also waits for the lock held until the upload was done to be released
+    thumbservice.upload_queue.get().shutdown()
+    response2 = thumbservice_client.get(f'/{frame["id"]}/?image=true')
+    assert response1.status_code == 200
+    assert response2.status_code == 200
+    assert response2.mimetype == 'image/jpeg'
+    assert response2.data == b'I Am Thumbnail'
+    assert thumbservice.jpeg_cache.get().stats()['hits'] == 1
+    assert len(list(tmp_path.glob('*'))) == 0
+
+
+def test_image_streamed_from_s3_fills_local_cache(thumbservice_client, requests_mock, s3_client, tmp_path_factory):
+    thumbservice.settings.DIRECT_IMAGE_RESPONSES = True
+    thumbservice.settings.LOCAL_CACHE_DIR = str(tmp_path_factory.mktemp('cache'))
+    frame = deepcopy(_test_data['frame'])
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    s3_client.put_object(Bucket=TEST_BUCKET, Key=thumbservice.key_for_jpeg(frame['id'], **thumbservice.get_params({})), Body=b'I Am Thumbnail')
+    response = thumbservice_client.get(f'/{frame["id"]}/?image=true')
+    assert response.data == b'I Am Thumbnail'
+    thumbservice.existing_keys.reset()
+    # Serving from the local cache does not ask S3 when the thumbnail was last modified
+    with mock.patch.object(thumbservice, 'get_s3_client', side_effect=AssertionError('S3 was called')):
+        response = thumbservice_client.get(f'/{frame["id"]}/?image=true')
+    assert response.status_code == 200
+    assert response.data == b'I Am Thumbnail'
+    assert thumbservice.jpeg_cache.get().stats()['hits'] == 1
+    assert thumbservice.fits_to_jpg.call_count == 0
+
+
+def test_generated_image_is_returned_while_it_is_uploaded(thumbservice_client, requests_mock, s3_client):
+    frame = deepcopy(_test_data['frame'])
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(frame['url'], content=b'I Am Image')
+    key = thumbservice.key_for_jpeg(frame['id'], **thumbservice.get_params({}))
+    uploading = threading.Event()
+    finish_upload = threading.Event()
+    upload_to_s3 = thumbservice.upload_queue.get().upload
+
+    def slow_upload(key, data):
+        uploading.set()
+        assert finish_upload.wait(5)
+        upload_to_s3(key, data)
+    thumbservice.upload_queue.get().upload = slow_upload
+    response = thumbservice_client.get(f'/{frame["id"]}/?image=true')
+    assert response.status_code == 200
+    assert response.data == b'I Am Thumbnail'
+    assert uploading.wait(5)
+    assert 'Contents' not in s3_client.list_objects_v2(Bucket=TEST_BUCKET)
+    finish_upload.set()
+    # Requests for the url wait for the upload to finish
+    response = thumbservice_client.get(f'/{frame["id"]}/')
+    assert response.status_code == 200
+    assert [obj['Key'] for obj in s3_client.list_objects_v2(Bucket=TEST_BUCKET)['Contents']] == [key]
+    assert thumbservice.fits_to_jpg.call_count == 1
+
+
+def test_failed_uploads_are_retried():
+    attempts = []
+
+    def upload(key, data):
+        attempts.append(key)
+        if len(attempts) < 3:
+            raise Exception('Something bad happened')
+    queue = uploads.UploadQueue(upload, max_workers=1, max_bytes=100, retries=2, backoff=0)
+    queue.submit('key', b'data')
+    queue.wait('key')
+    assert attempts == ['key', 'key', 'key']
+    assert queue.get('key') is None
+
+
+def test_lru_file_cache_evicts_least_recently_used_entries(tmp_path):
+    source = tmp_path / 'source'
+    source.write_bytes(b'12345')
+    lru = cache.LRUFileCache(str(tmp_path / 'cache'), max_bytes=100, max_entries=2)
+    lru.put('a', source)
+    lru.put('b', source)
+    os.utime(lru.path_for('a'), (1, 1))
+    os.utime(lru.path_for('b'), (2, 2))
+    lru.open('a').close()
+    lru.put('c', source)
+    assert lru.open('b') is None
+    assert lru.stats() == {'hits': 1, 'misses': 1, 'entries': 2, 'bytes': 10}
+
+
+def test_lru_file_cache_is_bounded_by_bytes(tmp_path):
+    source = tmp_path / 'source'
+    source.write_bytes(b'12345')
+    lru = cache.LRUFileCache(str(tmp_path / 'cache'), max_bytes=12, max_entries=10)
+    for key in ['a', 'b', 'c']:
+        lru.put(key, source)
+    assert lru.stats()['bytes'] <= 12
+
+
+def test_lru_file_cache_only_scans_once_it_may_be_over_its_bounds(tmp_path):
+    lru = cache.LRUFileCache(str(tmp_path / 'cache'), max_bytes=1000, max_entries=10)
+    with mock.patch.object(lru, 'entries', wraps=lru.entries) as entries:
+        for key in range(10):
+            lru.write(str(key), b'12345')
+        # Only the first write scans, to find out what is already there
+        assert entries.call_count == 1
+        lru.write('10', b'12345')
+        assert entries.call_count == 2
+    assert lru.stats()['entries'] == 9
+
+
+def test_existing_keys_and_presigned_urls_are_cached(thumbservice_client, requests_mock, s3_client):
+    frame = deepcopy(_test_data['frame'])
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(frame['url'], content=b'I Am Image')
+    response1 = thumbservice_client.get(f'/{frame["id"]}/')
+    # Without the cache the missing key would cause the thumbnail to be generated again
+    for key in s3_client.list_objects(Bucket=TEST_BUCKET)['Contents']:
+        s3_client.delete_object(Bucket=TEST_BUCKET, Key=key['Key'])
+    response2 = thumbservice_client.get(f'/{frame["id"]}/')
+    assert requests_mock.call_count == 3
+    assert response1.get_json()['url'] == response2.get_json()['url']
+
+
+def test_stale_entries_are_returned_while_they_are_refreshed():
+    refreshes = []
+    swr_cache = cache.StaleWhileRevalidateCache(10, 60, 600, refreshes.append)
+    with mock.patch('time.monotonic', return_value=1000):
+        assert swr_cache.get('key', lambda: 'old') == ('old', False)
+        assert swr_cache.get('key', lambda: 'new') == ('old', True)
+    assert refreshes == []
+    with mock.patch('time.monotonic', return_value=1100):
+        assert swr_cache.get('key', lambda: 'new') == ('old', True)
+        assert swr_cache.get('key', lambda: 'new') == ('old', True)
+        # Only one refresh is started at a time
+        assert len(refreshes) == 1
+        refreshes[0]()
+        assert swr_cache.get('key', lambda: 'newer') == ('new', True)
+    with mock.patch('time.monotonic', return_value=2000):
+        assert swr_cache.get('key', lambda: 'newest') == ('newest', False)
+
+
+def test_archive_metadata_is_cached_per_credential(thumbservice_client, requests_mock, s3_client):
+    thumbservice.settings.ARCHIVE_CACHE_MAX_ENTRIES = 100
+    frame = deepcopy(_test_data['frame'])
+    metadata = requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(frame['url'], content=b'I Am Image')
+    thumbservice_client.get(f'/{frame["id"]}/?width=200', headers={'Authorization': 'Token alice'})
+    thumbservice_client.get(f'/{frame["id"]}/?width=300', headers={'Authorization': 'Token alice'})
+    assert metadata.call_count == 1
+    # A frame fetched with one credential is not returned to another, or to anonymous requests
+    thumbservice_client.get(f'/{frame["id"]}/?width=200', headers={'Authorization': 'Token bob'})
+    thumbservice_client.get(f'/{frame["id"]}/?width=200')
+    assert metadata.call_count == 3
+    # Public frames are shared with everyone
+    thumbservice_client.get(f'/{frame["id"]}/?width=200', headers={'Authorization': 'Token carol'})
+    assert metadata.call_count == 3
+
+
+def test_ttl_cache_expires_and_evicts_entries():
+    ttl_cache = cache.TTLCache(max_entries=2, ttl=60)
+    ttl_cache.set('a', 1)
+    ttl_cache.set('b', 2, ttl=0)
+    assert ttl_cache.get('b') is None
+    ttl_cache.set('b', 2)
+    ttl_cache.get('a')
+    ttl_cache.set('c', 3)
+    assert ttl_cache.get('a') == 1
+    assert ttl_cache.get('b') is None
+    assert ttl_cache.get('c') == 3
+
+
+def test_admission_budget_admits_waiting_clients_in_turn():
+    budget = concurrency.AdmissionBudget(max_running=1, max_waiting=3, timeout=5)
+    first = budget.admit('alice')
+    admitted = []
+
+    def wait_for_admission(client):
+        with budget.admit(client):
+            admitted.append(client)
+    threads = []
+    for client in ['alice', 'alice', 'bob']:
+        threads.append(threading.Thread(target=wait_for_admission, args=(client,)))
+        threads[-1].start()
+        while budget.waiting < len(threads):
+            threading.Event().wait(0.01)
+    with pytest.raises(concurrency.Rejected):
+        budget.admit('carol')
+    first.release()
+    for thread in threads:
+        thread.join()
+    assert admitted == ['alice', 'bob', 'alice']
+    assert budget.running == 0
+
+
+def test_admission_budget_rejects_after_timeout():
+    budget = concurrency.AdmissionBudget(max_running=1, max_waiting=1, timeout=0.01)
+    with budget.admit('alice'):
+        with pytest.raises(concurrency.Rejected):
+            budget.admit('bob')
+    assert budget.waiting == 0
+    with budget.admit('bob'):
+        assert budget.running == 1
+
+
+def test_generation_is_rejected_when_the_budget_is_full(thumbservice_client, requests_mock, s3_client):
+    thumbservice.settings.EXPENSIVE_MAX_RUNNING = 0
+    thumbservice.settings.EXPENSIVE_MAX_WAITING = 0
+    frame = deepcopy(_test_data['frame'])
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(frame['url'], content=b'I Am Image')
+    response = thumbservice_client.get(f'/{frame["id"]}/')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(thumbservice.settings.ADMISSION_RETRY_AFTER)
+    assert thumbservice.fits_to_jpg.call_count == 0
+    text = thumbservice_client.get('/metrics').get_data(as_text=True)
+    assert 'thumbservice_admission_rejections_total{budget="expensive"} 1.0' in text
+    # Thumbnails that exist are still returned
+    s3_client.put_object(Bucket=TEST_BUCKET, Key=thumbservice.key_for_jpeg(frame['id'], **thumbservice.get_params({})), Body=b'I Am Thumbnail')
+    assert thumbservice_client.get(f'/{frame["id"]}/').status_code == 200
+
+
+def test_single_flight_coalesces_concurrent_calls_in_a_process(tmp_path):
+    single_flight = concurrency.SingleFlight(str(tmp_path), timeout=5)
+    release = threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        release.wait(5)
+        return 'result'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(single_flight.do('key', work))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    while not calls:
+        release.wait(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == ['result'] * 3
+    assert len(list(tmp_path.glob('*'))) == 0
+
+
+def test_single_flight_waits_for_leader_in_another_process(tmp_path):
+    # Separate instances only share the lock file, like separate worker processes
+    leader = concurrency.SingleFlight(str(tmp_path), timeout=5, poll_interval=0.01)
+    follower = concurrency.SingleFlight(str(tmp_path), timeout=5, poll_interval=0.01)
+    started = threading.Event()
+    done = []
+
+    def leader_work():
+        started.set()
+        threading.Event().wait(0.2)
+        done.append('leader')
+
+    def follower_work():
+        if not done:
+            done.append('follower')
+
+    thread = threading.Thread(target=lambda: leader.do('key', leader_work))
+    thread.start()
+    started.wait(5)
+    follower.do('key', follower_work)
+    thread.join()
+    assert done == ['leader']
+    assert len(list(tmp_path.glob('*'))) == 0
+
+
+def test_single_flight_holds_file_lock_until_background_work_is_done(tmp_path):
+    leader = concurrency.SingleFlight(str(tmp_path), timeout=5, poll_interval=0.01)
+    follower = concurrency.SingleFlight(str(tmp_path), timeout=0.05, poll_interval=0.01)
+    upload = concurrent.futures.Future()
+    assert leader.do('key', lambda: 'rendered', hold=lambda _: upload) == 'rendered'
+    # The follower gives up waiting for the lock, so generates it again
+    assert follower.do('key', lambda: 'rendered again') == 'rendered again'
+    assert len(list(tmp_path.glob('*'))) == 1
+    upload.set_result(None)
+    assert len(list(tmp_path.glob('*'))) == 0
+
+
+def test_single_flight_follower_generates_after_timeout(tmp_path):
+    single_flight = concurrency.SingleFlight(str(tmp_path), timeout=0.05, poll_interval=0.01)
+    with open(single_flight.lock_path('key'), 'w') as f:
+        concurrency.fcntl.flock(f, concurrency.fcntl.LOCK_EX)
+        assert single_flight.do('key', lambda: 'generated anyway') == 'generated anyway'
+
+
+def test_frame_cache_is_shared_between_thumbnail_sizes(thumbservice_client, requests_mock, s3_client, tmp_path):
+    thumbservice.settings.FRAME_CACHE_MAX_BYTES = 1024
+    frame = deepcopy(_test_data['frame'])
+    frame['url'] = 'http://file_url/frame.fits.fz?Signature=abc'
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(frame['url'], content=b'I Am Image')
+    response1 = thumbservice_client.get(f'/{frame["id"]}/?width=200')
+    frame['url'] = 'http://file_url/frame.fits.fz?Signature=def'
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    response2 = thumbservice_client.get(f'/{frame["id"]}/?width=500')
+    assert response1.status_code == 200
+    assert response2.status_code == 200
+    assert requests_mock.call_count == 3
+    # Only the cached frame is left behind
+    assert [path.name for path in tmp_path.glob('*')] == ['frame-cache']
+    assert len(list((tmp_path / 'frame-cache').glob('*'))) == 1
+
+
+def test_pinned_frames_are_not_evicted(tmp_path):
+    lru = cache.LRUFileCache(str(tmp_path / 'cache'), max_bytes=100, max_entries=1)
+    (tmp_path / 'a').write_bytes(b'a')
+    (tmp_path / 'b').write_bytes(b'b')
+    pin = lru.put_pinned('a', str(tmp_path / 'a'))
+    os.utime(pin.path, (1, 1))
+    lru.put('b', str(tmp_path / 'b'))
+    # The pinned entry is skipped even though it is the least recently used
+    assert os.path.exists(pin.path)
+    assert not os.path.exists(lru.path_for('b'))
+    pin.release()
+    lru.put('b', str(tmp_path / 'b'))
+    assert not os.path.exists(pin.path)
+    assert os.path.exists(lru.path_for('b'))
+
+
+def test_batch_thumbnails_return_a_result_per_frame(thumbservice_client, requests_mock, s3_client, tmp_path):
+    frame = deepcopy(_test_data['frame'])
+    other_frame = deepcopy(_test_data['request_frames']['results'][2])
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(f'{TEST_API_URL}frames/6/', json={'detail': 'Not found.'}, status_code=404)
+    requests_mock.get(f'{TEST_API_URL}frames/?basename=other_frame', json={'count': 1, 'results': [other_frame]})
+    requests_mock.get(frame['url'], content=b'I Am Image')
+    requests_mock.get(other_frame['url'], content=b'I Am Image')
+    response = thumbservice_client.post(
+        '/batch/?width=500', json={'frame_ids': [frame['id'], 6], 'basenames': ['other_frame']}
+    )
+    assert response.status_code == 200
+    results = response.get_json()
+    assert results['frame_ids'][str(frame['id'])]['propid'] == frame['proposal_id']
+    assert 'url' in results['frame_ids'][str(frame['id'])]
+    assert 'url' in results['basenames']['other_frame']
+    assert results['frame_ids']['6'] == {'message': 'Not found', 'status_code': 404}
+    assert len(list(tmp_path.glob('*'))) == 0
+
+
+def test_batch_frame_id_and_basename_that_look_the_same_are_both_returned(thumbservice_client, requests_mock, s3_client):
+    frame = deepcopy(_test_data['frame'])
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(f'{TEST_API_URL}frames/?basename={frame["id"]}', json={'count': 0, 'results': []})
+    requests_mock.get(frame['url'], content=b'I Am Image')
+    response = thumbservice_client.post('/batch/', json={'frame_ids': [frame['id']], 'basenames': [str(frame['id'])]})
+    results = response.get_json()
+    assert 'url' in results['frame_ids'][str(frame['id'])]
+    assert results['basenames'][str(frame['id'])] == {'message': 'Not found', 'status_code': 404}
+
+
+def test_batch_thumbnails_require_frames(thumbservice_client):
+    response = thumbservice_client.post('/batch/', json={})
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize('body', [{'frame_ids': ['abc']}, {'frame_ids': 123}, {'basenames': 'basename'}, {'basenames': [1]}, [1]])
+def test_batch_thumbnails_require_lists_of_frames(thumbservice_client, body):
+    response = thumbservice_client.post('/batch/', json=body)
+    assert response.status_code == 400
+
+
+def wait_for_job(thumbservice_client, status_url):
+    for _ in range(100):
+        job = thumbservice_client.get(status_url).get_json()
+        if job['status'] in ('done', 'failed'):
+            return job
+        threading.Event().wait(0.05)
+    raise AssertionError('Job did not finish')
+
+
+@pytest.mark.parametrize('backend', ['memory', 'sqlite'])
+def test_async_thumbnail_is_generated_by_a_job(thumbservice_client, requests_mock, s3_client, backend):
+    thumbservice.settings.JOB_QUEUE_BACKEND = backend
+    frame = deepcopy(_test_data['frame'])
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(frame['url'], content=b'I Am Image')
+    response = thumbservice_client.get(f'/{frame["id"]}/?async=true')
+    assert response.status_code == 202
+    job = wait_for_job(thumbservice_client, response.get_json()['status_url'])
+    assert job['status'] == 'done'
+    assert job['propid'] == frame['proposal_id']
+    # Once the thumbnail exists it is returned straight away
+    response = thumbservice_client.get(f'/{frame["id"]}/?async=true')
+    assert response.status_code == 200
+    assert response.get_json()['url'] == job['url']
+
+
+def test_async_thumbnail_job_reports_failures(thumbservice_client, requests_mock, s3_client):
+    frame = deepcopy(_test_data['frame'])
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(frame['url'], status_code=500)
+    response = thumbservice_client.get(f'/{frame["id"]}/?async=true')
+    job = wait_for_job(thumbservice_client, response.get_json()['status_url'])
+    assert job['status'] == 'failed'
+    assert job['status_code'] == 502
+
+
+def test_unfinished_jobs_of_an_exited_worker_are_failed(thumbservice_client):
+    store = thumbservice.job_store.get()
+    store.create('unfinished')
+    store.create('finished')
+    store.update('finished', 'done', {'url': 'https://example.com/thumbnail.jpg'})
+    with mock.patch.object(config, 'settings', thumbservice.settings):
+        config.child_exit(None, namedtuple('Worker', ['pid'])(os.getpid()))
+    assert thumbservice_client.get('/jobs/unfinished/').get_json() == dict(jobs.WORKER_EXITED, status='failed', job_id='unfinished')
+    assert thumbservice_client.get('/jobs/finished/').get_json()['status'] == 'done'
+
+
+def test_unknown_job_is_not_found(thumbservice_client):
+    response = thumbservice_client.get('/jobs/doesnotexist/')
+    assert response.status_code == 404
+
+
+def test_thumbnails_of_requests_are_warmed(thumbservice_client, requests_mock, s3_client):
+    thumbservice.settings.WARM_RATE = 0
+    frame = deepcopy(_test_data['frame'])
+    request_frames = deepcopy(_test_data['request_frames'])
+    requests_mock.get(f'{TEST_API_URL}frames/?request_id={frame["request_id"]}&reduction_level=91', json=request_frames)
+    for request_frame in request_frames['results']:
+        requests_mock.get(request_frame['url'], content=b'I Am Image')
+    # The black and white thumbnail of one of the frames already exists
+    s3_client.put_object(Bucket=TEST_BUCKET, Key=thumbservice.key_for_jpeg(frame['id'], **thumbservice.get_params({})), Body=b'I Am Thumbnail')
+    response = thumbservice_client.post('/warm/', json={'request_ids': [frame['request_id']]})
+    assert response.status_code == 202
+    job = wait_for_job(thumbservice_client, response.get_json()['status_url'])
+    assert job['status'] == 'done'
+    assert (job['generated'], job['skipped'], job['failed']) == (11, 1, 0)
+    # Later requests for the default thumbnails do not generate anything
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    for query in ['', '?color=true']:
+        assert thumbservice_client.get(f'/{frame["id"]}/{query}').status_code == 200
+    assert thumbservice.fits_to_jpg.call_count == 11
+
+
+def test_warming_requires_frames(thumbservice_client):
+    assert thumbservice_client.post('/warm/', json={}).status_code == 400
+
+
+@pytest.mark.parametrize('body', [{'frame_ids': ['abc']}, {'frame_ids': 123}, {'request_ids': '123'}, {'request_ids': [True]}])
+def test_warming_requires_lists_of_ids(thumbservice_client, body):
+    assert thumbservice_client.post('/warm/', json=body).status_code == 400
+
+
+@pytest.mark.parametrize('trusted_proxies, forwarded_for, client', [
+    (0, '1.1.1.1', '127.0.0.1'),
+    (1, '1.1.1.1, 2.2.2.2', '2.2.2.2'),
+    (2, '1.1.1.1, 2.2.2.2, 3.3.3.3', '2.2.2.2'),
+    (2, '3.3.3.3', '127.0.0.1'),
+])
+def test_clients_cannot_choose_their_own_address(trusted_proxies, forwarded_for, client):
+    thumbservice.settings.TRUSTED_PROXIES = trusted_proxies
+    with thumbservice.app.test_request_context(headers={'X-Forwarded-For': forwarded_for}, environ_base={'REMOTE_ADDR': '127.0.0.1'}):
+        assert thumbservice.client_key({}) == client
+
+
+def test_rate_limiter_spaces_out_calls():
+    limiter = concurrency.RateLimiter(rate=100, burst=2)
+    start = time.monotonic()
+    for _ in range(7):
+        limiter.wait()
+    # The first two calls are let through straight away
+    assert time.monotonic() - start >= 0.05
+
+
+def test_metrics_record_stage_timings_and_cache_lookups(thumbservice_client, requests_mock, s3_client):
+    frame = deepcopy(_test_data['frame'])
+    requests_mock.get(f'{TEST_API_URL}frames/{frame["id"]}/', json=frame)
+    requests_mock.get(frame['url'], content=b'I Am Image')
+    thumbservice_client.get(f'/{frame["id"]}/')
+    thumbservice_client.get(f'/{frame["id"]}/')
+    response = thumbservice_client.get('/metrics')
+    assert response.status_code == 200
+    text = response.get_data(as_text=True)
+    for stage, count in [('archive_metadata', 2), ('download', 1), ('render', 1), ('upload', 1), ('presign', 2)]:
+        assert f'thumbservice_stage_seconds_count{{stage="{stage}"}} {float(count)}' in text
+    assert 'thumbservice_cache_requests_total{cache="s3",result="hit"} 1.0' in text
+    assert 'thumbservice_cache_requests_total{cache="s3",result="miss"} 1.0' in text
+    assert 'thumbservice_downloaded_bytes_total 10.0' in text
+    assert 'thumbservice_generations_in_progress 0.0' in text
+
+
+def test_metrics_are_flushed_between_requests(tmp_path):
+    registry = metrics.Registry()
+    counter = metrics.Counter('requests_total', 'Requests', registry=registry)
+    counter.inc()
+    registry.start_flushing(str(tmp_path), 0.01)
+    try:
+        path = tmp_path / f'{os.getpid()}.json'
+        deadline = time.monotonic() + 5
+        while not path.exists() and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        registry.stop_flushing()
+    assert json.loads(path.read_text()) == registry.snapshot()
+
+
+def test_metrics_are_aggregated_across_worker_processes(tmp_path):
+    registry = metrics.Registry()
+    counter = metrics.Counter('requests_total', 'Requests', registry=registry)
+    gauge = metrics.Gauge('in_progress', 'In progress', registry=registry)
+    histogram = metrics.Histogram('seconds', 'Seconds', registry=registry, buckets=(1,))
+    counter.inc(2)
+    gauge.inc(3)
+    histogram.observe(0.5)
+    for pid in (100, 200):
+        with open(tmp_path / f'{pid}.json', 'w') as f:
+            f.write(json.dumps(registry.snapshot()))
+    metrics.mark_process_dead(str(tmp_path), 200)
+    text = registry.render(str(tmp_path))
+    assert 'requests_total 6.0' in text
+    # The gauge of the dead worker no longer counts
+    assert 'in_progress 6.0' in text
+    assert 'seconds_bucket{le="1.0"} 3.0' in text
+    assert 'seconds_count 3.0' in text
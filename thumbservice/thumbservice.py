@@ -1,42 +1,117 @@
 #!/usr/bin/env python
+import io
 import os
+import sys
+import json
+import time
 import uuid
 import logging
 import hashlib
+import resource
+import shutil
+import tempfile
+import threading
+import contextvars
+import multiprocessing
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_EXCEPTION
+from concurrent.futures.process import BrokenProcessPool
 
 import boto3
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask_cors import CORS
 from flask.logging import default_handler
-from flask import Flask, request, jsonify, redirect, send_from_directory
-from fits2image.conversions import fits_to_jpg
-from fits_align.ident import make_transforms
-from fits_align.align import affineremap
+from flask import Flask, Response, g, request, jsonify, redirect, send_file, send_from_directory, has_request_context, url_for
 
-from thumbservice.common import settings, get_temp_filename_prefix
+from thumbservice.cache import LRUFileCache, TTLCache, StaleWhileRevalidateCache
+from thumbservice.common import settings, get_temp_filename_prefix, ProcessLocal
+from thumbservice.concurrency import SingleFlight, AdmissionBudget, Rejected, RateLimiter
+from thumbservice.jobs import JobQueue, QueueFull, JOB_STORES, PENDING
+from thumbservice.uploads import UploadQueue
+from thumbservice import metrics
 
 
+PRESIGNED_URL_EXPIRES_IN = 3600 * 8
+
+
+# Rendering and aligning need astropy, fits2image and fits_align, which take most of the time it takes
+# to import this module. They are imported the first time they are used, so that worker processes that
+# only return existing thumbnails never pay for them
+def fits_to_jpg(*args, **kwargs):
+    from thumbservice.render import fits_to_jpg
+    return fits_to_jpg(*args, **kwargs)
+
+
+def fits_to_jpgs(*args, **kwargs):
+    from thumbservice.render import fits_to_jpgs
+    return fits_to_jpgs(*args, **kwargs)
+
+
+def make_transforms(reference_path, paths):
+    from fits_align.ident import make_transforms
+    return make_transforms(reference_path, paths)
+
+
+def preload_rendering():
+    """Import everything rendering and aligning need up front, rather than on the first render"""
+    import thumbservice.render  # noqa: F401
+    import fits_align.ident  # noqa: F401
+
 app = Flask(__name__, static_folder='static')
 CORS(app)
 
 class RequestFormatter(logging.Formatter):
     def format(self, record):
-        record.url = request.url
+        # Downloads run on worker threads that do not have a request context
+        record.url = request.url if has_request_context() else '-'
         return super().format(record)
 
 formatter = RequestFormatter('[%(asctime)s] %(levelname)s in %(module)s for %(url)s: %(message)s')
 default_handler.setFormatter(formatter)
 
 
+STAGE_SECONDS = metrics.Histogram(
+    'thumbservice_stage_seconds', 'Time spent in each stage of returning a thumbnail', ['stage']
+)
+CACHE_REQUESTS = metrics.Counter(
+    'thumbservice_cache_requests_total', 'Lookups of thumbnails and frames in each cache', ['cache', 'result']
+)
+DOWNLOADED_BYTES = metrics.Counter('thumbservice_downloaded_bytes_total', 'Bytes of FITS files downloaded')
+GENERATIONS_IN_PROGRESS = metrics.Gauge('thumbservice_generations_in_progress', 'Thumbnails currently being generated')
+PEAK_RSS_BYTES = metrics.Gauge(
+    'thumbservice_peak_rss_bytes', 'Largest peak resident set size of any worker process', aggregate='max'
+)
+ALIGNMENTS = metrics.Counter(
+    'thumbservice_alignments_total', 'Color thumbnails whose frames were aligned, or fell back to unaligned', ['result']
+)
+TEMP_DIR_BYTES = metrics.Gauge(
+    'thumbservice_temp_dir_bytes', 'Bytes used by files in the temp directory', aggregate='local'
+)
+ADMISSION_WAITING = metrics.Gauge(
+    'thumbservice_admission_waiting', 'Requests waiting for room in each admission budget', ['budget']
+)
+ADMISSION_REJECTIONS = metrics.Counter(
+    'thumbservice_admission_rejections_total', 'Requests turned away because an admission budget was full', ['budget']
+)
+
+
+def count_cache_request(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
 class ThumbnailAppException(Exception):
     status_code = 500
 
-    def __init__(self, message, status_code=None, payload=None):
+    def __init__(self, message, status_code=None, payload=None, headers=None):
         Exception.__init__(self)
         self.message = message
         if status_code is not None:
             self.status_code = status_code
         self.payload = payload
+        self.headers = headers
 
     def to_dict(self):
         result = dict(self.payload or ())
@@ -48,13 +123,90 @@ class ThumbnailAppException(Exception):
 def handle_thumbnail_app_exception(error):
     response = jsonify(error.to_dict())
     response.status_code = error.status_code
+    if error.headers:
+        response.headers.update(error.headers)
     return response
 
 
-def get_response(url, params=None, headers=None):
+def too_busy(message):
+    return ThumbnailAppException(message, status_code=503, headers={'Retry-After': str(settings.ADMISSION_RETRY_AFTER)})
+
+
+# Generating thumbnails takes far longer than returning ones that exist, so each gets its own budget
+# and a burst of generations cannot stop existing thumbnails from being returned
+admission_budgets = ProcessLocal(lambda: {
+    'cheap': AdmissionBudget(settings.CHEAP_MAX_RUNNING, settings.CHEAP_MAX_WAITING, settings.CHEAP_WAIT_TIMEOUT),
+    'expensive': AdmissionBudget(settings.EXPENSIVE_MAX_RUNNING, settings.EXPENSIVE_MAX_WAITING, settings.EXPENSIVE_WAIT_TIMEOUT),
+})
+
+
+def client_key(headers):
+    """Return who a request is from, so that waiting requests can be admitted fairly"""
+    authorization = (headers or {}).get('Authorization')
+    if authorization:
+        return hashlib.sha256(authorization.encode()).hexdigest()
+    if has_request_context():
+        return client_address()
+    return None
+
+
+def client_address():
+    """Return the address of the client as seen by the first of the TRUSTED_PROXIES in front of this service
+
+    Each proxy appends the address it got the request from to X-Forwarded-For, so only that many
+    addresses from the end can be trusted. Clients can put whatever they like before them.
+    """
+    forwarded_for = [address.strip() for address in request.headers.get('X-Forwarded-For', '').split(',') if address.strip()]
+    if settings.TRUSTED_PROXIES and len(forwarded_for) >= settings.TRUSTED_PROXIES:
+        return forwarded_for[-settings.TRUSTED_PROXIES]
+    return request.remote_addr
+
+
+@contextmanager
+def admission(budget_name, headers):
+    """Wait for room in the named admission budget, raising a 503 if there is not going to be any"""
+    budget = admission_budgets.get()[budget_name]
+    ADMISSION_WAITING.inc(budget=budget_name)
+    try:
+        admitted = budget.admit(client_key(headers))
+    except Rejected:
+        ADMISSION_REJECTIONS.inc(budget=budget_name)
+        raise too_busy('Too many thumbnails are being requested, try again later')
+    finally:
+        ADMISSION_WAITING.dec(budget=budget_name)
+    with admitted:
+        yield admitted
+
+
+def build_http_session():
+    retries = Retry(
+        total=settings.HTTP_RETRIES,
+        backoff_factor=settings.HTTP_RETRY_BACKOFF,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=('GET', 'HEAD'),
+        # Hand the final response back so that its status code is handled in get_response
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_maxsize=settings.HTTP_POOL_MAXSIZE, max_retries=retries)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+http_session = ProcessLocal(build_http_session)
+
+
+def get_response(url, params=None, headers=None, stream=False):
     response = None
     try:
-        response = requests.get(url, headers=headers, params=params, timeout=10)
+        response = http_session.get().get(
+            url,
+            headers=headers,
+            params=params,
+            timeout=(settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT),
+            stream=stream
+        )
         response.raise_for_status()
     except requests.RequestException:
         status_code = getattr(response, 'status_code', None)
@@ -73,14 +225,14 @@ def get_response(url, params=None, headers=None):
     return response
 
 
-def can_generate_thumbnail_on(frame, request):
+def can_generate_thumbnail_on(frame, params):
     frame_has_required_validation_keys = all([key in frame.keys() for key in settings.REQUIRED_FRAME_VALIDATION_KEYS])
     if not frame_has_required_validation_keys:
         return {'result': False, 'reason': 'Cannot generate thumbnail for given frame'}
 
     configuration_type = frame.get('configuration_type').upper()
     request_id = frame.get('request_id')
-    is_color_request = request.args.get('color', 'false') == 'true'
+    is_color_request = params['color']
     is_fits_file = any([frame.get('filename').endswith(ext) for ext in ['.fits', '.fits.fz']])
 
     if configuration_type not in settings.VALID_CONFIGURATION_TYPES:
@@ -102,26 +254,293 @@ def unique_temp_path_start():
     return f'{settings.TMP_DIR}{get_temp_filename_prefix()}{uuid.uuid4().hex}-'
 
 
-def save_temp_file(frame):
+def peak_rss_kb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class DownloadBudget:
+    """The bytes that every frame downloaded for one request, such as the frames of a batch, may add up to"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.downloaded = 0
+        self._lock = threading.Lock()
+
+    def check(self, frame, size):
+        """Raise a 400 if downloading size more bytes of the frame would go over the budget"""
+        self._check_total(frame, self.downloaded + size)
+
+    def add(self, frame, size):
+        with self._lock:
+            self.downloaded += size
+            # Only the download that goes over the budget fails, not the ones that got there first
+            downloaded = self.downloaded
+        self._check_total(frame, downloaded)
+
+    def _check_total(self, frame, total):
+        if self.max_bytes and total > self.max_bytes:
+            raise ThumbnailAppException(
+                f'Cannot generate thumbnails from frames adding up to more than {self.max_bytes} bytes',
+                status_code=400,
+                payload={'filename': frame['filename']}
+            )
+
+
+# Set for each request, and carried over to the threads that download frames or generate thumbnails for it
+download_budget = contextvars.ContextVar('download_budget', default=None)
+
+
+def run_with_download_budget(fn, *args):
+    """Call fn with a budget of its own for the frames it downloads"""
+    context = contextvars.copy_context()
+    context.run(download_budget.set, DownloadBudget(settings.MAX_DOWNLOAD_BYTES))
+    return context.run(fn, *args)
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+def remove_if_exists(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def stream_frame(frame, f, cancel_event=None):
+    """Write the frame to the file object f chunk by chunk so that it is never held in memory in full"""
+    start = time.monotonic()
+    bytes_written = 0
+    # Outside of a request, the frame only has to fit within a budget of its own
+    budget = download_budget.get() or DownloadBudget(settings.MAX_DOWNLOAD_BYTES)
+    response = get_response(frame['url'], stream=True)
+    try:
+        budget.check(frame, int(response.headers.get('Content-Length', 0)))
+        for chunk in response.iter_content(chunk_size=settings.DOWNLOAD_CHUNK_SIZE):
+            if cancel_event is not None and cancel_event.is_set():
+                raise DownloadCancelled(frame['filename'])
+            bytes_written += len(chunk)
+            budget.add(frame, len(chunk))
+            f.write(chunk)
+    except requests.RequestException:
+        raise ThumbnailAppException('Got error response', status_code=502)
+    finally:
+        response.close()
+        DOWNLOADED_BYTES.inc(bytes_written)
+    PEAK_RSS_BYTES.set(peak_rss_kb() * 1024)
+    app.logger.info(
+        f'Downloaded {bytes_written} bytes for {frame["filename"]} in {time.monotonic() - start:.2f}s, '
+        f'peak RSS {peak_rss_kb()} KB'
+    )
+
+
+@STAGE_SECONDS.time(stage='download')
+def save_temp_file(frame, cancel_event=None):
     path = f'{unique_temp_path_start()}{frame["filename"]}'
-    with open(path, 'wb') as f:
-        f.write(get_response(frame['url']).content)
+    try:
+        with open(path, 'wb') as f:
+            stream_frame(frame, f, cancel_event)
+    except Exception:
+        # The path has not been handed back to the caller yet, so nothing else will clean it up
+        remove_if_exists(path)
+        raise
     return path
 
 
+@STAGE_SECONDS.time(stage='download')
+def download_to_buffer(frame, cancel_event=None):
+    """Download the frame into memory, spilling over to an anonymous temp file if it is too large
+
+    The anonymous file has no name in the temp dir, so it is removed as soon as it is closed.
+    """
+    buffer = tempfile.SpooledTemporaryFile(max_size=settings.IN_MEMORY_DECODE_MAX_BYTES, dir=settings.TMP_DIR)
+    try:
+        stream_frame(frame, buffer, cancel_event)
+    except Exception:
+        buffer.close()
+        raise
+    buffer.seek(0)
+    return buffer
+
+
+download_executor = ProcessLocal(
+    lambda: ThreadPoolExecutor(max_workers=settings.MAX_CONCURRENT_DOWNLOADS, thread_name_prefix='download')
+)
+
+
+def build_frame_cache():
+    if not settings.FRAME_CACHE_MAX_BYTES:
+        return None
+    return LRUFileCache(settings.FRAME_CACHE_DIR, settings.FRAME_CACHE_MAX_BYTES, settings.FRAME_CACHE_MAX_ENTRIES)
+
+
+frame_cache = ProcessLocal(build_frame_cache)
+
+
+def frame_cache_key(frame):
+    # Archive download urls are usually presigned, so only the part before the query string is stable
+    url_path = frame['url'].split('?')[0]
+    return f'{frame["id"]}-{hashlib.blake2b(url_path.encode(), digest_size=8).hexdigest()}-{frame["filename"]}'
+
+
+def fetch_frame(frame, paths, cancel_event=None, in_memory=False):
+    """Return the path to the frame on disk, taken from the frame cache if it is enabled
+
+    If in_memory is set and neither the frame cache nor IN_MEMORY_DECODE_MAX_BYTES turn it off, a
+    file object holding the downloaded frame is returned instead. Everything created is registered
+    with paths so that it is cleaned up or released afterwards.
+    """
+    cache = frame_cache.get()
+    if cache is None and in_memory and settings.IN_MEMORY_DECODE_MAX_BYTES:
+        buffer = download_to_buffer(frame, cancel_event)
+        paths.add_file(buffer)
+        return buffer
+    if cache is None:
+        path = save_temp_file(frame, cancel_event)
+        paths.add(path)
+        return path
+    key = frame_cache_key(frame)
+    pin = cache.pin(key)
+    count_cache_request('frame', pin is not None)
+    if pin is None:
+        pin = cache.put_pinned(key, save_temp_file(frame, cancel_event))
+    paths.add_pin(pin)
+    return pin.path
+
+
+def fetch_frames(frames, paths, in_memory=False):
+    """Fetch frames in parallel, returning their paths or file objects in the same order as the frames
+
+    If any download fails, the others are cancelled and waited on before the error is raised, so
+    that everything they created is registered with paths.
+    """
+    cancel_event = threading.Event()
+    futures = [
+        download_executor.get().submit(contextvars.copy_context().run, fetch_frame, frame, paths, cancel_event, in_memory)
+        for frame in frames
+    ]
+    done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+    failed = [future for future in done if future.exception() is not None]
+    if failed:
+        cancel_event.set()
+        for future in not_done:
+            future.cancel()
+        wait(not_done)
+        raise failed[0].exception()
+    return [future.result() for future in futures]
+
+
 def key_for_jpeg(frame_id, **params):
     return f'{frame_id}.{hashlib.blake2b(repr(frozenset(params.items())).encode(), digest_size=20).hexdigest()}.jpg'
 
 
-def convert_to_jpg(paths, key, **params):
-    jpg_path = f'{unique_temp_path_start()}{key}'
-    fits_to_jpg(paths, jpg_path, **params)
-    return jpg_path
+def warm_render_worker():
+    # Runs as each render process starts, so that the first render does not pay for the imports
+    preload_rendering()
 
 
-def get_s3_client():
-    config = boto3.session.Config(region_name='us-west-2', signature_version='s3v4')
-    return boto3.client(
+def build_render_executor():
+    if settings.RENDER_EXECUTOR == 'inline':
+        return None
+    if settings.RENDER_EXECUTOR != 'process':
+        raise ValueError(f'Unknown RENDER_EXECUTOR {settings.RENDER_EXECUTOR}, must be one of inline, process')
+    max_workers = settings.RENDER_PROCESSES or len(os.sched_getaffinity(0))
+    # Render processes start from scratch rather than being forked from a worker that may be
+    # running gevent and holding locks
+    executor = ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'), initializer=warm_render_worker
+    )
+    # Processes are started as tasks are submitted, so start them all now rather than on the first renders
+    for _ in range(max_workers):
+        executor.submit(int)
+    return executor
+
+
+render_executor = ProcessLocal(build_render_executor)
+
+
+def run_cpu_bound(fn, *args):
+    """Call fn in a render process if RENDER_EXECUTOR is process, otherwise in this one
+
+    Waiting for the result lets other requests in this worker keep running, including under gevent.
+    """
+    executor = render_executor.get()
+    if executor is None:
+        return fn(*args)
+    try:
+        return executor.submit(fn, *args).result()
+    except BrokenProcessPool:
+        # A render process died, for example because it ran out of memory. Start over with a new pool
+        render_executor.reset()
+        raise
+
+
+def sendable_sources(sources, paths):
+    """Return the sources, in a form that can be sent to another process if they are going to one
+
+    Frames held in memory are read out as bytes. Frames that have spilled over to an anonymous file
+    are copied to a named file in the temp dir instead, which is registered with paths, so that they
+    are read off disk in the render process rather than read into memory here and pickled.
+    """
+    if render_executor.get() is None:
+        return sources
+    sendable = []
+    for source in sources:
+        if hasattr(source, 'read'):
+            # Buffers spill over to their anonymous file once they hold more than IN_MEMORY_DECODE_MAX_BYTES
+            size = source.seek(0, os.SEEK_END)
+            source.seek(0)
+            if size > settings.IN_MEMORY_DECODE_MAX_BYTES:
+                path = f'{unique_temp_path_start()}frame.fits'
+                paths.add(path)
+                with open(path, 'wb') as f:
+                    shutil.copyfileobj(source, f)
+                source = path
+            else:
+                source = source.read()
+        sendable.append(source)
+    return sendable
+
+
+def readable_sources(sources):
+    return [io.BytesIO(source) if isinstance(source, bytes) else source for source in sources]
+
+
+def render_jpg(sources, transforms, params):
+    buffer = io.BytesIO()
+    fits_to_jpg(readable_sources(sources), buffer, transforms=transforms, **params)
+    return buffer.getvalue()
+
+
+def render_jpgs(sources, sizes, transforms, params):
+    buffers = [io.BytesIO() for _ in sizes]
+    fits_to_jpgs(
+        readable_sources(sources), [(buffer, width, height) for buffer, (width, height) in zip(buffers, sizes)],
+        transforms=transforms, **params
+    )
+    return [buffer.getvalue() for buffer in buffers]
+
+
+@STAGE_SECONDS.time(stage='render')
+def convert_to_jpg(sources, paths, transforms=None, **params):
+    return run_cpu_bound(render_jpg, sendable_sources(sources, paths), transforms, params)
+
+
+@STAGE_SECONDS.time(stage='render')
+def convert_to_jpgs(sources, paths, renditions, transforms=None):
+    """Render a jpg for each (key, params) in renditions, which differ only in size, returning their bytes"""
+    params = {name: value for name, value in renditions[0][1].items() if name not in ('width', 'height')}
+    sizes = [(rendition_params['width'], rendition_params['height']) for _, rendition_params in renditions]
+    return run_cpu_bound(render_jpgs, sendable_sources(sources, paths), sizes, transforms, params)
+
+
+def build_s3_client():
+    config = boto3.session.Config(
+        region_name='us-west-2',
+        signature_version='s3v4',
+        max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+    )
+    # Sessions are not thread safe, but the clients created from them are
+    return boto3.session.Session().client(
         's3',
         aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
         aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
@@ -130,43 +549,176 @@ def get_s3_client():
     )
 
 
-def upload_to_s3(key, jpg_path):
-    client = get_s3_client()
-    with open(jpg_path, 'rb') as f:
-        client.put_object(
-            Bucket=settings.AWS_BUCKET,
-            Body=f,
-            Key=key,
-            ContentType='image/jpeg'
-        )
+s3_client = ProcessLocal(build_s3_client)
 
 
-def generate_url(key):
+def get_s3_client():
+    return s3_client.get()
+
+
+# Remember which keys are known to be in S3, and the presigned urls handed out for them, so that
+# repeat requests for popular thumbnails do not need a round trip to S3
+existing_keys = ProcessLocal(lambda: TTLCache(settings.S3_CACHE_MAX_ENTRIES, settings.S3_KEY_EXISTS_TTL))
+presigned_urls = ProcessLocal(
+    lambda: TTLCache(settings.S3_CACHE_MAX_ENTRIES, PRESIGNED_URL_EXPIRES_IN - settings.PRESIGNED_URL_MIN_REMAINING)
+)
+
+
+@STAGE_SECONDS.time(stage='upload')
+def upload_to_s3(key, data):
     client = get_s3_client()
-    return client.generate_presigned_url(
-        'get_object',
-        ExpiresIn=3600 * 8,
-        Params={'Bucket': settings.AWS_BUCKET, 'Key': key}
+    client.put_object(
+        Bucket=settings.AWS_BUCKET,
+        Body=data,
+        Key=key,
+        ContentType='image/jpeg'
     )
+    presigned_urls.get().delete(key)
+    existing_keys.get().set(key, datetime.now(timezone.utc))
 
 
-def key_exists(key):
+upload_queue = ProcessLocal(lambda: UploadQueue(
+    upload_to_s3, settings.UPLOAD_WORKERS, settings.UPLOAD_QUEUE_MAX_BYTES, settings.UPLOAD_RETRIES, settings.HTTP_RETRY_BACKOFF
+))
+
+
+@STAGE_SECONDS.time(stage='presign')
+def generate_url(key):
+    url = presigned_urls.get().get(key)
+    if url is None:
+        client = get_s3_client()
+        url = client.generate_presigned_url(
+            'get_object',
+            ExpiresIn=PRESIGNED_URL_EXPIRES_IN,
+            Params={'Bucket': settings.AWS_BUCKET, 'Key': key}
+        )
+        presigned_urls.get().set(key, url)
+    return url
+
+
+@STAGE_SECONDS.time(stage='key_exists')
+def key_last_modified(key):
+    """Return when the key was last written to S3, or None if it is not there"""
+    last_modified = existing_keys.get().get(key)
+    if last_modified is not None:
+        return last_modified
     client = get_s3_client()
     try:
-        client.head_object(Bucket=settings.AWS_BUCKET, Key=key)
-        return True
+        response = client.head_object(Bucket=settings.AWS_BUCKET, Key=key)
     except:
-        return False
+        return None
+    existing_keys.get().set(key, response['LastModified'])
+    return response['LastModified']
+
+
+def key_exists(key):
+    # Thumbnails that this process is still uploading are as good as in S3
+    return upload_queue.get().get(key) is not None or key_last_modified(key) is not None
 
 
-def frames_for_requestnum(request_id, request, reduction_level):
-    headers = {
+def build_jpeg_cache():
+    if not settings.LOCAL_CACHE_DIR:
+        return None
+    return LRUFileCache(settings.LOCAL_CACHE_DIR, settings.LOCAL_CACHE_MAX_BYTES, settings.LOCAL_CACHE_MAX_ENTRIES)
+
+
+jpeg_cache = ProcessLocal(build_jpeg_cache)
+
+
+def warm_up():
+    """Build the clients and pools of this process, so that the first requests it handles do not wait for them"""
+    get_s3_client()
+    http_session.get()
+    render_executor.get()
+
+
+def archive_headers(request):
+    return {
         'Authorization': request.headers.get('Authorization')
     }
+
+
+@STAGE_SECONDS.time(stage='archive_metadata')
+def request_frame_by_id(frame_id, headers):
+    return get_response(f'{settings.ARCHIVE_API_URL}frames/{frame_id}/', headers=headers).json()
+
+
+@STAGE_SECONDS.time(stage='archive_metadata')
+def request_frame_by_basename(frame_basename, headers):
+    params = {'basename': frame_basename}
+    frames = get_response(f'{settings.ARCHIVE_API_URL}frames/', params=params, headers=headers).json()
+
+    if not frames['count'] == 1:
+        raise ThumbnailAppException('Not found', status_code=404)
+
+    return frames['results'][0]
+
+
+@STAGE_SECONDS.time(stage='archive_metadata')
+def request_frames_for_requestnum(request_key, headers):
+    request_id, reduction_level = request_key
     params = {'request_id': request_id, 'reduction_level': reduction_level}
     return get_response(f'{settings.ARCHIVE_API_URL}frames/', params=params, headers=headers).json()['results']
 
 
+def log_refresh_failures(future):
+    if future.exception() is not None:
+        app.logger.warning(f'Failed to refresh archive metadata: {future.exception()}')
+
+
+def submit_archive_refresh(refresh):
+    future = archive_refresh_executor.get().submit(refresh)
+    future.add_done_callback(log_refresh_failures)
+    return future
+
+
+archive_refresh_executor = ProcessLocal(
+    lambda: ThreadPoolExecutor(max_workers=settings.ARCHIVE_CACHE_REFRESH_WORKERS, thread_name_prefix='archive-refresh')
+)
+archive_cache = ProcessLocal(lambda: StaleWhileRevalidateCache(
+    settings.ARCHIVE_CACHE_MAX_ENTRIES, settings.ARCHIVE_CACHE_TTL, settings.ARCHIVE_CACHE_STALE_TTL, submit_archive_refresh
+))
+
+
+def credential_scope(headers):
+    """Return the part of a cache key that keeps what was fetched with one credential from every other credential"""
+    authorization = (headers or {}).get('Authorization')
+    if not authorization:
+        return 'public'
+    return hashlib.sha256(authorization.encode()).hexdigest()
+
+
+def cached_archive_lookup(kind, ref, headers, fetch):
+    """Return what fetch returns for ref, from the archive metadata cache if it is there
+
+    Entries are kept separately for each credential. Frames looked up without one are public, so they
+    are also returned to requests that have a credential.
+    """
+    cache = archive_cache.get()
+    scope = credential_scope(headers)
+    if scope != 'public' and kind != 'request':
+        # The frames of a request that are public may only be some of them, so those are never shared
+        value = cache.peek((kind, 'public', ref))
+        if value is not None:
+            count_cache_request('archive', True)
+            return value
+    value, hit = cache.get((kind, scope, ref), lambda: fetch(ref, headers))
+    count_cache_request('archive', hit)
+    return value
+
+
+def get_frame_by_id(frame_id, headers):
+    return cached_archive_lookup('frame', frame_id, headers, request_frame_by_id)
+
+
+def get_frame_by_basename(frame_basename, headers):
+    return cached_archive_lookup('basename', frame_basename, headers, request_frame_by_basename)
+
+
+def frames_for_requestnum(request_id, headers, reduction_level):
+    return cached_archive_lookup('request', (request_id, reduction_level), headers, request_frames_for_requestnum)
+
+
 def rvb_frames(frames):
     FILTERS_FOR_COLORS = {
         'red': ['R', 'rp'],
@@ -184,116 +736,533 @@ def rvb_frames(frames):
     return selected_frames
 
 
-def reproject_files(ref_image, images_to_align):
-    """Return three aligned images."""
-    aligned_images = []
-    reprojected_file_list = [ref_image]
-    try:
-        identifications = make_transforms(ref_image, images_to_align[1:3])
-        for id in identifications:
-            if id.ok:
-                aligned_image = affineremap(id.ukn.filepath, id.trans, outdir=settings.TMP_DIR)
-                aligned_images.append(aligned_image)
-    except Exception:
-        app.logger.warning('Error aligning images, falling back to original image list', exc_info=True)
+def build_alignment_cache():
+    if not settings.ALIGNMENT_CACHE_MAX_ENTRIES:
+        return None
+    # Entries are a few hundred bytes each, so they are only bounded by number
+    return LRUFileCache(settings.ALIGNMENT_CACHE_DIR, sys.maxsize, settings.ALIGNMENT_CACHE_MAX_ENTRIES)
+
+
+alignment_cache = ProcessLocal(build_alignment_cache)
+
+
+def alignment_cache_key(frames):
+    return '-'.join(str(frame['id']) for frame in frames) + '.json'
+
 
-    # Clean up aligned images if they will not be used
-    if len(aligned_images) != 2:
-        while len(aligned_images) > 0:
-            aligned_image = aligned_images.pop()
-            if os.path.exists(aligned_image):
-                os.remove(aligned_image)
+def load_alignment(frames):
+    """Return whether the alignment of the RVB frames is cached, and the cached transforms"""
+    cache = alignment_cache.get()
+    if cache is None:
+        return False, None
+    f = cache.open(alignment_cache_key(frames))
+    count_cache_request('alignment', f is not None)
+    if f is None:
+        return False, None
+    with f:
+        vectors = json.load(f)
+    if vectors is None:
+        return True, None
+    from fits_align.star import SimpleTransform
+    return True, [None if v is None else SimpleTransform(v) for v in vectors]
 
-    reprojected_file_list = reprojected_file_list + aligned_images
-    return reprojected_file_list if len(reprojected_file_list) == 3 else images_to_align
+
+def save_alignment(frames, transforms):
+    cache = alignment_cache.get()
+    if cache is not None:
+        vectors = None if transforms is None else [None if t is None else [float(x) for x in t.v] for t in transforms]
+        cache.write(alignment_cache_key(frames), json.dumps(vectors).encode())
+
+
+def find_transforms(reference_path, paths):
+    """Return the transform mapping each of the frames at paths onto the reference frame, or None if it was not found"""
+    return [identification.trans if identification.ok else None for identification in make_transforms(reference_path, paths)]
+
+
+@STAGE_SECONDS.time(stage='align')
+def align_frames(frames, paths):
+    """Return the transforms that align each of the RVB frames onto the red one, or None if they cannot be
+
+    The result is kept in the alignment cache so that other thumbnails of the same frames skip
+    identifying stars. The frames are warped by the transforms in memory when the thumbnail is rendered.
+    """
+    try:
+        found = run_cpu_bound(find_transforms, paths[0], paths[1:3])
+    except Exception:
+        app.logger.warning('Error aligning images, falling back to unaligned images', exc_info=True)
+        return None
+    if len(found) != 2 or None in found:
+        app.logger.warning('Could not align all of the images, falling back to unaligned images')
+        transforms = None
+    else:
+        transforms = [None] + found
+    save_alignment(frames, transforms)
+    return transforms
 
 
 class Paths:
-    """Retain all paths set"""
+    """Retain all paths added, and any cache entries pinned or files opened while they are used"""
     def __init__(self):
         self._all_paths = set()
-        self.paths = []
+        self._pins = []
+        self._files = []
+
+    def add(self, path):
+        self._all_paths.add(path)
+
+    def add_pin(self, pin):
+        self._pins.append(pin)
 
-    def set(self, paths):
-        for path in paths:
-            self._all_paths.add(path)
-        self.paths = paths
+    def add_file(self, f):
+        self._files.append(f)
 
     @property
     def all_paths(self):
         return list(self._all_paths)
 
+    def clean_up(self):
+        # Cached frames are left in place for the next request to use
+        pinned_paths = {pin.path for pin in self._pins}
+        for path in self._all_paths - pinned_paths:
+            remove_if_exists(path)
+        for pin in self._pins:
+            pin.release()
+        for f in self._files:
+            f.close()
 
-def generate_thumbnail(frame, request):
+
+def get_params(args):
     params = {
-        'width': int(request.args.get('width', 200)),
-        'height': int(request.args.get('height', 200)),
-        'label_text': request.args.get('label'),
-        'color': request.args.get('color', 'false') != 'false',
-        'median': request.args.get('median', 'false') != 'false',
-        'percentile': float(request.args.get('percentile', 99.5)),
-        'quality': int(request.args.get('quality', 80)),
+        'width': int(args.get('width', 200)),
+        'height': int(args.get('height', 200)),
+        'label_text': args.get('label'),
+        'color': args.get('color', 'false') != 'false',
+        'median': args.get('median', 'false') != 'false',
+        'percentile': float(args.get('percentile', 99.5)),
+        'quality': int(args.get('quality', 80)),
     }
-    key = key_for_jpeg(frame['id'], **params)
+    # Only set when asked for, so that the keys of thumbnails without them stay the same
+    if args.get('preview', 'false') != 'false':
+        params['preview'] = True
+    if args.get('progressive', 'false') != 'false':
+        params['progressive'] = True
+    return params
+
+
+def open_cached_jpeg(frame, params):
+    cache = jpeg_cache.get()
+    if cache is None:
+        return None
+    cached_jpeg = cache.open(key_for_jpeg(frame['id'], **params))
+    count_cache_request('local', cached_jpeg is not None)
+    return cached_jpeg
+
+
+def other_renditions(frame, key, params):
+    """Return the (key, params) of each of the standard sizes of the thumbnail that are not in S3 yet"""
+    renditions = []
+    for size in settings.RENDITION_SIZES:
+        rendition_params = dict(params, width=size, height=size)
+        rendition_key = key_for_jpeg(frame['id'], **rendition_params)
+        if rendition_key != key and not key_exists(rendition_key):
+            renditions.append((rendition_key, rendition_params))
+    return renditions
+
+
+def render_thumbnail(frame, key, params, headers, renditions=False, background_upload=False):
+    """Generate the thumbnail and return its bytes, or None if it is already in S3
+
+    The other renditions are uploaded in the background, and so is the thumbnail itself if
+    background_upload is set. Otherwise it is in S3 by the time this returns.
+    """
+    # Another request may have generated the thumbnail while this one waited for it
     if key_exists(key):
-        return generate_url(key)
-    # Cfitsio is a bit crappy and can only read data off disk
-    jpg_path = None
+        return upload_queue.get().get(key)
+    renditions = [(key, params)] + (other_renditions(frame, key, params) if renditions else [])
+    transforms = None
     paths = Paths()
+    GENERATIONS_IN_PROGRESS.inc()
     try:
         if not params['color']:
-            paths.set([save_temp_file(frame)])
+            # The frame is decoded straight from memory unless it is too large to hold there
+            sources = [fetch_frame(frame, paths, in_memory=True)]
         else:
             # Color thumbnails can only be generated on rlevel 91 images
-            reqnum_frames = frames_for_requestnum(frame['request_id'], request, reduction_level=91)
-            paths.set([save_temp_file(frame) for frame in rvb_frames(reqnum_frames)])
-            paths.set(reproject_files(paths.paths[0], paths.paths))
-        jpg_path = convert_to_jpg(paths.paths, key, **params)
-        upload_to_s3(key, jpg_path)
+            frames = rvb_frames(frames_for_requestnum(frame['request_id'], headers, reduction_level=91))
+            cached, transforms = load_alignment(frames)
+            # Finding the transforms reads the frames off disk, so they only need to go there on a miss
+            sources = fetch_frames(frames, paths, in_memory=cached)
+            if not cached:
+                transforms = align_frames(frames, sources)
+            ALIGNMENTS.inc(result='fallback' if transforms is None else 'aligned')
+        if len(renditions) == 1:
+            jpgs = [convert_to_jpg(sources, paths, transforms=transforms, **params)]
+        else:
+            jpgs = convert_to_jpgs(sources, paths, renditions, transforms=transforms)
+        for (rendition_key, _), data in zip(renditions, jpgs):
+            if jpeg_cache.get() is not None:
+                jpeg_cache.get().write(rendition_key, data)
+            if rendition_key == key and not background_upload:
+                upload_to_s3(key, data)
+            else:
+                upload_queue.get().submit(rendition_key, data)
+        return jpgs[0]
     finally:
         # Cleanup actions
-        if jpg_path and os.path.exists(jpg_path):
-            os.remove(jpg_path)
-        for path in paths.all_paths:
-            if os.path.exists(path):
-                os.remove(path)
+        paths.clean_up()
+        GENERATIONS_IN_PROGRESS.dec()
+
+
+single_flight = ProcessLocal(lambda: SingleFlight(settings.TMP_DIR, settings.SINGLE_FLIGHT_TIMEOUT))
+
+
+def ensure_thumbnail(frame, params, headers, renditions=False, background_upload=False):
+    """Return the S3 key of the thumbnail, generating it first if it is not in S3
+
+    The bytes of the thumbnail are also returned if this process has them in memory, otherwise None.
+    If renditions is set, a thumbnail that has to be generated is also generated at the standard sizes.
+    """
+    key = key_for_jpeg(frame['id'], **params)
+    exists = key_exists(key)
+    count_cache_request('s3', exists)
+    if exists:
+        return key, upload_queue.get().get(key)
+    if has_request_context() and 'cheap_admission' in g:
+        # Make room for requests for existing thumbnails while this one waits to be generated
+        g.cheap_admission.release()
+
+    def generate():
+        with admission('expensive', headers):
+            return render_thumbnail(frame, key, params, headers, renditions, background_upload)
+    # Identical requests that arrive together share the work of generating the thumbnail. Other
+    # processes wait until it is uploaded, or they would find it missing from S3 and generate it again.
+    data = single_flight.get().do(key, generate, hold=lambda _: upload_queue.get().future(key))
+    return key, data
+
+
+def generate_thumbnail(frame, params, headers, renditions=False):
+    """Return the url of the thumbnail, generating it first if it is not in S3"""
+    key, _ = ensure_thumbnail(frame, params, headers, renditions)
+    # The url is only good once the thumbnail is in S3, and another request may still be uploading it
+    upload_queue.get().wait(key)
     return generate_url(key)
 
 
-def handle_response(frame, request):
-    can_generate_thumbnail_on_frame = can_generate_thumbnail_on(frame, request)
+def thumbnail_etag(key):
+    # Keys are a hash of the frame and of every parameter of the thumbnail, so they identify its contents
+    return key.rsplit('.', 1)[0]
+
+
+def add_caching_headers(response, key, last_modified, request):
+    response.set_etag(thumbnail_etag(key))
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if request.headers.get('Authorization'):
+        # Thumbnails of proprietary frames must not be kept by shared caches
+        response.cache_control.private = True
+        response.vary.add('Authorization')
+    else:
+        response.cache_control.public = True
+    response.cache_control.max_age = settings.IMAGE_MAX_AGE
+    return response
+
+
+def stream_into_jpeg_cache(key, chunks):
+    """Yield the chunks, writing them into the local cache once all of them have been streamed"""
+    cache = jpeg_cache.get()
+    streamed = []
+    for chunk in chunks:
+        if cache is not None:
+            streamed.append(chunk)
+        yield chunk
+    if cache is not None:
+        cache.write(key, b''.join(streamed))
+
+
+def local_image_response(frame, params, request, renditions=False):
+    """Return the S3 key of the thumbnail, and a response with its bytes if this process has them, otherwise None
+
+    The bytes come from the local cache, or from generating the thumbnail, in which case they are
+    returned while it is uploaded.
+    """
+    key = key_for_jpeg(frame['id'], **params)
+    cached_jpeg = open_cached_jpeg(frame, params)
+    if cached_jpeg is not None:
+        response = send_file(cached_jpeg, mimetype='image/jpeg')
+        # Last-Modified is only sent if this process already knows it, rather than asking S3 for it
+        response.last_modified = existing_keys.get().get(key)
+        return key, response
+    key, data = ensure_thumbnail(frame, params, archive_headers(request), renditions, background_upload=True)
+    if data is None:
+        return key, None
+    response = send_file(io.BytesIO(data), mimetype='image/jpeg')
+    response.last_modified = datetime.now(timezone.utc)
+    return key, response
+
+
+def serve_image(frame, params, request, renditions=False):
+    """Return the bytes of the thumbnail, with headers that let browsers and CDNs cache them"""
+    key = key_for_jpeg(frame['id'], **params)
+    if request.if_none_match.contains_weak(thumbnail_etag(key)):
+        return add_caching_headers(Response(status=304), key, None, request)
+    key, response = local_image_response(frame, params, request, renditions)
+    if response is not None:
+        return add_caching_headers(response, key, response.last_modified, request)
+    obj = get_s3_client().get_object(Bucket=settings.AWS_BUCKET, Key=key)
+    response = Response(
+        stream_into_jpeg_cache(key, obj['Body'].iter_chunks(settings.DOWNLOAD_CHUNK_SIZE)), mimetype='image/jpeg'
+    )
+    response.content_length = obj['ContentLength']
+    return add_caching_headers(response, key, obj['LastModified'], request)
+
+
+def validate_frame(frame, params):
+    can_generate_thumbnail_on_frame = can_generate_thumbnail_on(frame, params)
     if not can_generate_thumbnail_on_frame['result']:
         raise ThumbnailAppException(can_generate_thumbnail_on_frame['reason'], status_code=400)
 
-    url = generate_thumbnail(frame, request)
+
+def build_job_store():
+    if settings.JOB_QUEUE_BACKEND not in JOB_STORES:
+        raise ValueError(f'Unknown JOB_QUEUE_BACKEND {settings.JOB_QUEUE_BACKEND}, must be one of {", ".join(JOB_STORES)}')
+    return JOB_STORES[settings.JOB_QUEUE_BACKEND](settings)
+
+
+job_store = ProcessLocal(build_job_store)
+job_queue = ProcessLocal(lambda: JobQueue(job_store.get(), settings.JOB_WORKERS, settings.JOB_QUEUE_MAX_PENDING))
+
+
+def enqueue_thumbnail(frame, params, headers, renditions=False):
+    try:
+        context = contextvars.copy_context()
+        job_id = job_queue.get().submit(lambda: context.run(
+            lambda: {'url': generate_thumbnail(frame, params, headers, renditions), 'propid': frame['proposal_id']}
+        ))
+    except QueueFull:
+        raise too_busy('Too many thumbnails are being generated, try again later')
+    response = jsonify({
+        'job_id': job_id,
+        'status': PENDING,
+        'status_url': url_for('job_status', job_id=job_id, _external=True),
+    })
+    response.status_code = 202
+    return response
+
+
+def get_renditions(args):
+    return args.get('renditions', 'false') != 'false'
+
+
+def handle_response(frame, request):
+    params = get_params(request.args)
+    validate_frame(frame, params)
+    renditions = get_renditions(request.args)
+
+    if request.args.get('async', 'false') != 'false' and not key_exists(key_for_jpeg(frame['id'], **params)):
+        # Hand the work off rather than tying up this worker, the client polls the job for the result
+        return enqueue_thumbnail(frame, params, archive_headers(request), renditions)
+
+    if request.args.get('image') and settings.DIRECT_IMAGE_RESPONSES:
+        return serve_image(frame, params, request, renditions)
     if request.args.get('image'):
-        return redirect(url)
+        key, response = local_image_response(frame, params, request, renditions)
+        if response is not None:
+            return response
+        upload_queue.get().wait(key)
+        return redirect(generate_url(key))
     else:
-        return jsonify({'url': url, 'propid': frame['proposal_id']})
+        return jsonify({'url': generate_thumbnail(frame, params, archive_headers(request), renditions), 'propid': frame['proposal_id']})
 
 
 @app.route('/<frame_basename>/')
 def bn_thumbnail(frame_basename):
-    headers = {
-        'Authorization': request.headers.get('Authorization')
-    }
-    params = {'basename': frame_basename}
-    frames = get_response(f'{settings.ARCHIVE_API_URL}frames/', params=params, headers=headers).json()
-
-    if not frames['count'] == 1:
-        raise ThumbnailAppException('Not found', status_code=404)
+    with admission('cheap', archive_headers(request)) as g.cheap_admission:
+        frame = get_frame_by_basename(frame_basename, archive_headers(request))
 
-    return handle_response(frames['results'][0], request)
+        return handle_response(frame, request)
 
 
 @app.route('/<int:frame_id>/')
 def thumbnail(frame_id):
-    headers = {
-        'Authorization': request.headers.get('Authorization')
+    with admission('cheap', archive_headers(request)) as g.cheap_admission:
+        frame = get_frame_by_id(frame_id, archive_headers(request))
+
+        return handle_response(frame, request)
+
+
+@app.route('/jobs/<job_id>/')
+def job_status(job_id):
+    job = job_store.get().get(job_id)
+    if job is None:
+        raise ThumbnailAppException('Not found', status_code=404)
+    return jsonify(dict(job, job_id=job_id))
+
+
+batch_executor = ProcessLocal(
+    lambda: ThreadPoolExecutor(max_workers=settings.MAX_CONCURRENT_BATCH_THUMBNAILS, thread_name_prefix='batch')
+)
+
+
+def batch_thumbnail(get_frame, frame_ref, params, headers, renditions=False):
+    """Return the result for a single frame of a batch, reporting errors rather than raising them"""
+    try:
+        frame = get_frame(frame_ref, headers)
+        validate_frame(frame, params)
+        return {'url': generate_thumbnail(frame, params, headers, renditions), 'propid': frame['proposal_id']}
+    except ThumbnailAppException as e:
+        return dict(e.to_dict(), status_code=e.status_code)
+    except Exception:
+        app.logger.exception(f'Failed to generate thumbnail for {frame_ref}')
+        return {'message': 'Failed to generate thumbnail', 'status_code': 500}
+
+
+def list_from_body(body, name, item_type, description):
+    """Return the list under name in the JSON body, raising a 400 unless it is a list of item_type"""
+    items = body.get(name, []) if isinstance(body, dict) else None
+    # JSON booleans are ints to Python
+    if not isinstance(items, list) or not all(isinstance(item, item_type) and not isinstance(item, bool) for item in items):
+        raise ThumbnailAppException(f'{name} must be a list of {description}', status_code=400)
+    return items
+
+
+@app.route('/batch/', methods=['POST'])
+def batch():
+    """Return thumbnails for many frames, given by frame_ids and basenames in the JSON body
+
+    The thumbnail parameters are taken from the query string and shared by all of the frames.
+    """
+    body = request.get_json(silent=True) or {}
+    # A frame id and a basename can look the same, so each is looked up and reported under its own kind
+    frame_refs = {
+        'frame_ids': (get_frame_by_id, list_from_body(body, 'frame_ids', int, 'integers')),
+        'basenames': (get_frame_by_basename, list_from_body(body, 'basenames', str, 'strings')),
     }
-    frame = get_response(f'{settings.ARCHIVE_API_URL}frames/{frame_id}/', headers=headers).json()
+    total = sum(len(refs) for _, refs in frame_refs.values())
+    if not total:
+        raise ThumbnailAppException('Provide a list of frame_ids or basenames', status_code=400)
+    if total > settings.BATCH_MAX_FRAMES:
+        raise ThumbnailAppException(f'Cannot generate more than {settings.BATCH_MAX_FRAMES} thumbnails at once', status_code=400)
+
+    params = get_params(request.args)
+    headers = archive_headers(request)
+    renditions = get_renditions(request.args)
+    futures = {
+        kind: {
+            str(frame_ref): batch_executor.get().submit(
+                contextvars.copy_context().run, batch_thumbnail, get_frame, frame_ref, params, headers, renditions
+            )
+            for frame_ref in refs
+        }
+        for kind, (get_frame, refs) in frame_refs.items()
+    }
+    return jsonify({
+        kind: {frame_ref: future.result() for frame_ref, future in kind_futures.items()}
+        for kind, kind_futures in futures.items()
+    })
+
+
+WARMED = metrics.Counter(
+    'thumbservice_warmed_total', 'Thumbnails considered for warming, by whether they were generated', ['result']
+)
+# Warming runs one thumbnail at a time, spaced out by the rate limit, so live requests come first
+warm_queue = ProcessLocal(lambda: JobQueue(job_store.get(), 1, settings.WARM_MAX_PENDING))
+warm_rate_limiter = ProcessLocal(lambda: RateLimiter(settings.WARM_RATE))
+
+
+def warm_frame(frame, headers, counts):
+    """Generate the default black and white and color thumbnails of a frame that are not in S3 yet"""
+    for params in [get_params({}), get_params({'color': 'true'})]:
+        try:
+            validate_frame(frame, params)
+        except ThumbnailAppException:
+            continue
+        if key_exists(key_for_jpeg(frame['id'], **params)):
+            result = 'skipped'
+        else:
+            warm_rate_limiter.get().wait()
+            try:
+                run_with_download_budget(ensure_thumbnail, frame, params, headers)
+                result = 'generated'
+            except Exception:
+                app.logger.warning(f'Failed to warm thumbnail of frame {frame["id"]}', exc_info=True)
+                result = 'failed'
+        WARMED.inc(result=result)
+        counts[result] += 1
+
+
+def warm_thumbnails(frame_ids, request_ids, headers):
+    """Generate the default thumbnails of the frames, and of the frames of the requests, returning how many were generated"""
+    counts = {'generated': 0, 'skipped': 0, 'failed': 0}
+    for frame_id in frame_ids:
+        try:
+            frame = get_frame_by_id(frame_id, headers)
+        except ThumbnailAppException:
+            app.logger.warning(f'Could not find frame {frame_id} to warm')
+            counts['failed'] += 1
+            continue
+        warm_frame(frame, headers, counts)
+    for request_id in request_ids:
+        # Only processed frames can have color thumbnails, and they are what users look at
+        try:
+            frames = frames_for_requestnum(request_id, headers, reduction_level=91)
+        except ThumbnailAppException:
+            app.logger.warning(f'Could not find the frames of request {request_id} to warm')
+            counts['failed'] += 1
+            continue
+        for frame in frames:
+            warm_frame(frame, headers, counts)
+    return counts
+
+
+@app.route('/warm/', methods=['POST'])
+def warm():
+    """Generate the default thumbnails of the frame_ids and request_ids in the JSON body in the background"""
+    body = request.get_json(silent=True) or {}
+    frame_ids = list_from_body(body, 'frame_ids', int, 'integers')
+    request_ids = list_from_body(body, 'request_ids', int, 'integers')
+    if not frame_ids and not request_ids:
+        raise ThumbnailAppException('Provide a list of frame_ids or request_ids', status_code=400)
+    headers = archive_headers(request)
+    try:
+        job_id = warm_queue.get().submit(lambda: warm_thumbnails(frame_ids, request_ids, headers))
+    except QueueFull:
+        raise too_busy('Too many thumbnails are being warmed, try again later')
+    response = jsonify({
+        'job_id': job_id,
+        'status': PENDING,
+        'status_url': url_for('job_status', job_id=job_id, _external=True),
+    })
+    response.status_code = 202
+    return response
+
+
+def temp_dir_usage():
+    total = 0
+    for directory, _, filenames in os.walk(settings.TMP_DIR):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(directory, filename))
+            except OSError:
+                pass
+    return total
+
+
+@app.before_request
+def start_download_budget():
+    download_budget.set(DownloadBudget(settings.MAX_DOWNLOAD_BYTES))
+
+
+@app.after_request
+def flush_metrics(response):
+    metrics.REGISTRY.flush(settings.METRICS_DIR, min_interval=settings.METRICS_FLUSH_INTERVAL)
+    return response
+
 
-    return handle_response(frame, request)
+@app.route('/metrics')
+def metrics_endpoint():
+    # The temp dir is shared by all of the workers, so it is measured here rather than by each of them
+    TEMP_DIR_BYTES.set(temp_dir_usage())
+    return Response(metrics.REGISTRY.render(settings.METRICS_DIR), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/favicon.ico')
@@ -0,0 +1,92 @@
+import time
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class UploadQueue:
+    """Upload data held in memory on a bounded pool of threads, retrying uploads that fail
+
+    The data of queued uploads is bounded by max_bytes. Once that is reached, uploads are done in the
+    calling thread instead, so memory stays bounded without dropping anything. Until an upload is
+    done its data can be read with get, so that this process can still return it.
+    """
+    def __init__(self, upload, max_workers, max_bytes, retries, backoff):
+        self.upload = upload
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self.backoff = backoff
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='upload')
+        self._pending = {}
+        self._pending_bytes = 0
+        self._lock = threading.Lock()
+
+    def submit(self, key, data):
+        with self._lock:
+            if key in self._pending:
+                return
+            queued = self._pending_bytes + len(data) <= self.max_bytes
+            if queued:
+                future = Future()
+                self._pending[key] = (data, future)
+                self._pending_bytes += len(data)
+        if not queued:
+            self.upload_with_retries(key, data)
+            return
+        try:
+            self._executor.submit(self._run, key, data, future)
+        except RuntimeError:
+            # The executor has been shut down
+            self._finish(key, data)
+            raise
+
+    def _run(self, key, data, future):
+        try:
+            self.upload_with_retries(key, data)
+        except Exception as e:
+            logger.error(f'Giving up uploading {key}', exc_info=True)
+            future.set_exception(e)
+        else:
+            future.set_result(None)
+        finally:
+            self._finish(key, data)
+
+    def _finish(self, key, data):
+        with self._lock:
+            del self._pending[key]
+            self._pending_bytes -= len(data)
+
+    def upload_with_retries(self, key, data):
+        for attempt in range(self.retries + 1):
+            try:
+                return self.upload(key, data)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f'Failed to upload {key}, retrying', exc_info=True)
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def get(self, key):
+        """Return the data of the upload of key if it is still in progress, or None"""
+        with self._lock:
+            pending = self._pending.get(key)
+        return None if pending is None else pending[0]
+
+    def future(self, key):
+        """Return a Future of the upload of key if it is still in progress, or None"""
+        with self._lock:
+            pending = self._pending.get(key)
+        return None if pending is None else pending[1]
+
+    def wait(self, key, timeout=None):
+        """Wait for the upload of key to finish if it is in progress, raising the exception if it failed"""
+        with self._lock:
+            pending = self._pending.get(key)
+        if pending is not None:
+            pending[1].result(timeout=timeout)
+
+    def shutdown(self):
+        """Wait for all of the queued uploads to finish"""
+        self._executor.shutdown(wait=True)
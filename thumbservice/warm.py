@@ -0,0 +1,34 @@
+"""Generate the default thumbnails of frames ahead of time, so that the first people to look at them do not wait
+
+Takes frame ids and request ids, and generates the thumbnails of the frames of each request. Thumbnails
+that already exist are skipped, and the rest are generated at WARM_RATE per second. Uses the same
+configuration as the service. Run with, for example:
+
+    python -m thumbservice.warm --request-ids 1756835 --authorization 'Token abc123'
+"""
+import sys
+import json
+import argparse
+
+from thumbservice import thumbservice
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frame-ids', type=int, nargs='*', default=[], help='Frames to generate thumbnails of')
+    parser.add_argument('--request-ids', type=int, nargs='*', default=[], help='Requests to generate thumbnails of the frames of')
+    parser.add_argument('--authorization', help='Authorization header passed to the archive API, needed for proprietary frames')
+    args = parser.parse_args()
+    if not args.frame_ids and not args.request_ids:
+        parser.error('Provide --frame-ids or --request-ids')
+
+    counts = thumbservice.warm_thumbnails(args.frame_ids, args.request_ids, {'Authorization': args.authorization})
+    # Wait for thumbnails still being uploaded in the background
+    thumbservice.upload_queue.get().shutdown()
+    json.dump(counts, sys.stdout)
+    print()
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())